@@ -4,7 +4,12 @@
 #cython: cdivision=True
 
 from cython.operator cimport preincrement as inc, predecrement as dec
-from libc.stdlib cimport malloc, free
+from libc.stdlib cimport malloc, calloc, free
+from libc.math cimport log
+from libc.stdint cimport uint64_t
+
+
+DEF LGAMMA_TABLE_SIZE = 256
 
 
 cdef extern from "gamma.h":
@@ -18,7 +23,7 @@ cdef double lgamma(double x) nogil:
     return lda_lgamma(x)
 
 
-cdef int searchsorted(double* arr, int length, double value) nogil:
+cdef int searchsorted(double* arr, int length, double value) noexcept nogil:
     """Bisection search (c.f. numpy.searchsorted)
 
     Find the index into sorted array `arr` of length `length` such that, if
@@ -36,14 +41,54 @@ cdef int searchsorted(double* arr, int length, double value) nogil:
             imax = imid
     return imin
 
+cdef inline double uniform(uint64_t* state) noexcept nogil:
+    """Draw a double in [0, 1) from the xorshift64* generator `state` (nonzero)
+
+    Reference: Vigna, Sebastiano. "An Experimental Exploration of Marsaglia's
+    xorshift Generators, Scrambled." ACM Transactions on Mathematical Software
+    42 (2016).
+    """
+    cdef uint64_t x = state[0]
+    x ^= x >> 12
+    x ^= x << 25
+    x ^= x >> 27
+    state[0] = x
+    # top 53 bits of the scrambled output
+    return (x * <uint64_t> 2685821657736338717 >> 11) * (1.0 / 9007199254740992.0)
+
+cdef inline double _ll_enter(double eta_zw, int nzw_zw, double eta_sum_z, int nz_z,
+                            double alpha_dz, int ndz_dz) noexcept nogil:
+    """Change of log p(w,z) when a token enters counts nzw[z, w], nz[z], ndz[d, z]
+
+    Follows from lgamma(x + 1) = lgamma(x) + log(x); a token leaving the
+    same (post-removal) counts changes log p(w,z) by the negative.
+    """
+    return log(eta_zw + nzw_zw) - log(eta_sum_z + nz_z) + log(alpha_dz + ndz_dz)
+
+
+cdef void _lgamma_table(double a, double* table, int n) noexcept nogil:
+    """table[i] = lgamma(a + i) - lgamma(a) for i < n"""
+    cdef int i
+    table[0] = 0
+    for i in range(1, n):
+        table[i] = table[i - 1] + log(a + i - 1)
+
 # def double sum_up()
 
 def _sample_topics(int[:] WS, int[:] DS, int[:] ZS, int[:, :] nzw, int[:, :] ndz, int[:] nz,
-                   double[:, :] alpha, double[:, :] eta, double[:] eta_sum, double[:] rands):
+                   double[:, :] alpha, double[:, :] eta, double[:] eta_sum, uint64_t[:] rng_state,
+                   double[:] ll_delta=None):
+    """Samples all topic assignments from the full conditional.
+
+    If `ll_delta` is given, the change of the complete log likelihood
+    log p(w,z) caused by the sweep is added to ll_delta[0].
+    """
     cdef int i, k, w, d, z, z_new
     cdef double r, dist_cum
+    cdef double ll_acc = 0
+    cdef bint track_ll = ll_delta is not None
     cdef int N = WS.shape[0]
-    cdef int n_rand = rands.shape[0]
+    cdef uint64_t state = rng_state[0]
     cdef int n_topics = nz.shape[0]
     # cdef double eta_sum = 0
     cdef double* dist_sum = <double*> malloc(n_topics * sizeof(double))
@@ -68,28 +113,479 @@ def _sample_topics(int[:] WS, int[:] DS, int[:] ZS, int[:, :] nzw, int[:, :] ndz
                 dist_cum += (nzw[k, w] + eta[k, w]) / (nz[k] + eta_sum[k]) * (ndz[d, k] + alpha[d, k])
                 dist_sum[k] = dist_cum
 
-            r = rands[i % n_rand] * dist_cum  # dist_cum == dist_sum[-1]
+            r = uniform(&state) * dist_cum  # dist_cum == dist_sum[-1]
             z_new = searchsorted(dist_sum, n_topics, r)
 
+            if track_ll and z_new != z:
+                ll_acc += (_ll_enter(eta[z_new, w], nzw[z_new, w], eta_sum[z_new], nz[z_new],
+                                     alpha[d, z_new], ndz[d, z_new]) -
+                           _ll_enter(eta[z, w], nzw[z, w], eta_sum[z], nz[z], alpha[d, z], ndz[d, z]))
             ZS[i] = z_new
             inc(nzw[z_new, w])
             inc(ndz[d, z_new])
             inc(nz[z_new])
 
+        rng_state[0] = state
+        if track_ll:
+            ll_delta[0] += ll_acc
         free(dist_sum)
 
 
-cpdef double _loglikelihood(int[:, :] nzw, int[:, :] ndz, int[:] nz, int[:] nd, double[:, :] alpha_m, double[:, :] eta_m, double[:] alpha_sum, double[:] eta_sum) nogil:
+cdef void _remove_topic(int* topics, int* length, int k) noexcept nogil:
+    """Remove topic `k` from the unordered list `topics` of size `length`."""
+    cdef int j
+    for j in range(length[0]):
+        if topics[j] == k:
+            length[0] -= 1
+            topics[j] = topics[length[0]]
+            return
+
+
+def _sample_topics_sparse(int[:] WS, int[:] DS, int[:] ZS, int[:, :] nzw, int[:, :] ndz, int[:] nz,
+                          double[:, :] alpha, double[:] alpha_floor, int[:] alpha_flat,
+                          double[:] eta_floor, int[:] eta_res_ptr, int[:] eta_res_topics, double[:] eta_res,
+                          double[:] eta_sum, uint64_t[:] rng_state, double[:] ll_delta=None):
+    """Samples all topic assignments with the SparseLDA bucket decomposition.
+
+    With eta[k, w] = eta_floor[w] + residual[k, w] and
+    alpha[d, k] = alpha_floor[d] + residual[d, k] the conditional splits into
+
+        s = eta_floor[w] * alpha_floor[d] / (nz[k] + eta_sum[k])
+        r = eta_floor[w] * (ndz[d, k] + alpha[d, k] - alpha_floor[d]) / (nz[k] + eta_sum[k])
+        q = (nzw[k, w] + eta[k, w] - eta_floor[w]) * (ndz[d, k] + alpha[d, k]) / (nz[k] + eta_sum[k])
+
+    so a token only visits the topics present in its document and the topics
+    with a nonzero count or prior residual for its word. The smoothing bucket
+    is walked over all topics, but carries little mass.
+
+    The residual of eta is given word-major (CSC layout): the topics of word
+    w are eta_res_topics[eta_res_ptr[w]:eta_res_ptr[w + 1]]. `alpha_flat[d]`
+    is nonzero when row d of alpha equals alpha_floor[d]. Tokens must be
+    grouped by document, as produced by `OLDA.matrix_to_lists`. The
+    generator state `rng_state[0]` is advanced in place and, as in
+    `_sample_topics`, the change of log p(w,z) is added to `ll_delta[0]`.
+
+    Reference: Yao, Mimno and McCallum. "Efficient Methods for Topic Model
+    Inference on Streaming Document Collections." KDD 2009.
+    """
+    cdef int i, j, k, w, d, z, z_new, n_q, cur_d, end
+    cdef double r, s_sum, r_sum, q_sum, s_mass, r_mass, dist_cum
+    cdef double ll_acc = 0
+    cdef bint track_ll = ll_delta is not None
+    cdef int N = WS.shape[0]
+    cdef uint64_t state = rng_state[0]
+    cdef int n_topics = nz.shape[0]
+    cdef int vocab_size = nzw.shape[1]
+    cdef int d_len = 0
+    cdef double* inv_den = <double*> malloc(n_topics * sizeof(double))
+    cdef double* q_cum = <double*> malloc(n_topics * sizeof(double))
+    cdef int* q_topics = <int*> malloc(n_topics * sizeof(int))
+    cdef double* res_buf = <double*> malloc(n_topics * sizeof(double))
+    cdef int* d_topics = <int*> malloc(n_topics * sizeof(int))
+    cdef int* mark = <int*> malloc(n_topics * sizeof(int))
+    cdef int* w_len = <int*> malloc(vocab_size * sizeof(int))
+    cdef int* w_topics = <int*> malloc(<size_t> vocab_size * n_topics * sizeof(int))
+    if (inv_den is NULL or q_cum is NULL or q_topics is NULL or res_buf is NULL or
+            d_topics is NULL or mark is NULL or w_len is NULL or w_topics is NULL):
+        free(inv_den); free(q_cum); free(q_topics); free(res_buf)
+        free(d_topics); free(mark); free(w_len); free(w_topics)
+        raise MemoryError("Could not allocate memory during sampling.")
+    with nogil:
+        s_sum = 0
+        for k in range(n_topics):
+            inv_den[k] = 1.0 / (nz[k] + eta_sum[k])
+            s_sum += inv_den[k]
+            res_buf[k] = 0
+            mark[k] = 0
+        # topics with a nonzero count, per word
+        for w in range(vocab_size):
+            w_len[w] = 0
+            for k in range(n_topics):
+                if nzw[k, w] > 0:
+                    w_topics[<size_t> w * n_topics + w_len[w]] = k
+                    inc(w_len[w])
+
+        cur_d = -1
+        r_sum = 0
+        for i in range(N):
+            w = WS[i]
+            d = DS[i]
+            z = ZS[i]
+
+            if d != cur_d:
+                # topics present in the new document, read off its tokens
+                cur_d = d
+                d_len = 0
+                if alpha_flat[d]:
+                    end = i
+                    while end < N and DS[end] == d:
+                        k = ZS[end]
+                        if not mark[k]:
+                            mark[k] = 1
+                            d_topics[d_len] = k
+                            inc(d_len)
+                        inc(end)
+                    for j in range(d_len):
+                        mark[d_topics[j]] = 0
+                else:
+                    for k in range(n_topics):
+                        d_topics[k] = k
+                    d_len = n_topics
+                r_sum = 0
+                for j in range(d_len):
+                    k = d_topics[j]
+                    r_sum += (ndz[d, k] + alpha[d, k] - alpha_floor[d]) * inv_den[k]
+
+            # remove the token
+            s_sum -= inv_den[z]
+            r_sum -= (ndz[d, z] + alpha[d, z] - alpha_floor[d]) * inv_den[z]
+            dec(nzw[z, w])
+            dec(ndz[d, z])
+            dec(nz[z])
+            inv_den[z] = 1.0 / (nz[z] + eta_sum[z])
+            s_sum += inv_den[z]
+            r_sum += (ndz[d, z] + alpha[d, z] - alpha_floor[d]) * inv_den[z]
+            if alpha_flat[d] and ndz[d, z] == 0:
+                _remove_topic(d_topics, &d_len, z)
+            if nzw[z, w] == 0:
+                _remove_topic(w_topics + <size_t> w * n_topics, &w_len[w], z)
+
+            # topic-word bucket over nonzero counts and prior residuals
+            for j in range(eta_res_ptr[w], eta_res_ptr[w + 1]):
+                res_buf[eta_res_topics[j]] = eta_res[j]
+            q_sum = 0
+            n_q = 0
+            for j in range(w_len[w]):
+                k = w_topics[<size_t> w * n_topics + j]
+                q_sum += (nzw[k, w] + res_buf[k]) * (ndz[d, k] + alpha[d, k]) * inv_den[k]
+                q_cum[n_q] = q_sum
+                q_topics[n_q] = k
+                inc(n_q)
+            for j in range(eta_res_ptr[w], eta_res_ptr[w + 1]):
+                k = eta_res_topics[j]
+                if nzw[k, w] == 0:
+                    q_sum += res_buf[k] * (ndz[d, k] + alpha[d, k]) * inv_den[k]
+                    q_cum[n_q] = q_sum
+                    q_topics[n_q] = k
+                    inc(n_q)
+
+            r_mass = eta_floor[w] * r_sum
+            s_mass = eta_floor[w] * alpha_floor[d] * s_sum
+            r = uniform(&state) * (q_sum + r_mass + s_mass)
+            if r < q_sum:
+                z_new = q_topics[searchsorted(q_cum, n_q, r)]
+            elif r < q_sum + r_mass:
+                r = (r - q_sum) / eta_floor[w]
+                dist_cum = 0
+                z_new = d_topics[d_len - 1]
+                for j in range(d_len):
+                    k = d_topics[j]
+                    dist_cum += (ndz[d, k] + alpha[d, k] - alpha_floor[d]) * inv_den[k]
+                    if r < dist_cum:
+                        z_new = k
+                        break
+            else:
+                r = (r - q_sum - r_mass) / (eta_floor[w] * alpha_floor[d])
+                dist_cum = 0
+                z_new = n_topics - 1
+                for k in range(n_topics):
+                    dist_cum += inv_den[k]
+                    if r < dist_cum:
+                        z_new = k
+                        break
+
+            if track_ll and z_new != z:
+                ll_acc += (_ll_enter(eta_floor[w] + res_buf[z_new], nzw[z_new, w], eta_sum[z_new], nz[z_new],
+                                     alpha[d, z_new], ndz[d, z_new]) -
+                           _ll_enter(eta_floor[w] + res_buf[z], nzw[z, w], eta_sum[z], nz[z],
+                                     alpha[d, z], ndz[d, z]))
+            for j in range(eta_res_ptr[w], eta_res_ptr[w + 1]):
+                res_buf[eta_res_topics[j]] = 0
+
+            # add the token back
+            s_sum -= inv_den[z_new]
+            r_sum -= (ndz[d, z_new] + alpha[d, z_new] - alpha_floor[d]) * inv_den[z_new]
+            ZS[i] = z_new
+            inc(nzw[z_new, w])
+            inc(ndz[d, z_new])
+            inc(nz[z_new])
+            inv_den[z_new] = 1.0 / (nz[z_new] + eta_sum[z_new])
+            s_sum += inv_den[z_new]
+            r_sum += (ndz[d, z_new] + alpha[d, z_new] - alpha_floor[d]) * inv_den[z_new]
+            if alpha_flat[d] and ndz[d, z_new] == 1:
+                d_topics[d_len] = z_new
+                inc(d_len)
+            if nzw[z_new, w] == 1:
+                w_topics[<size_t> w * n_topics + w_len[w]] = z_new
+                inc(w_len[w])
+
+        rng_state[0] = state
+        if track_ll:
+            ll_delta[0] += ll_acc
+        free(inv_den)
+        free(q_cum)
+        free(q_topics)
+        free(res_buf)
+        free(d_topics)
+        free(mark)
+        free(w_len)
+        free(w_topics)
+
+
+cdef void _build_alias(double* prob, int* alias, int* small, int* large, int n) noexcept nogil:
+    """Vose's alias table, built in place from the unnormalised weights in `prob`."""
+    cdef int j, l, g
+    cdef int n_small = 0
+    cdef int n_large = 0
+    cdef double total = 0
+    for j in range(n):
+        total += prob[j]
+    for j in range(n):
+        prob[j] = prob[j] * n / total
+        alias[j] = j
+        if prob[j] < 1:
+            small[n_small] = j
+            inc(n_small)
+        else:
+            large[n_large] = j
+            inc(n_large)
+    while n_small > 0 and n_large > 0:
+        dec(n_small)
+        l = small[n_small]
+        dec(n_large)
+        g = large[n_large]
+        alias[l] = g
+        prob[g] = prob[g] + prob[l] - 1
+        if prob[g] < 1:
+            small[n_small] = g
+            inc(n_small)
+        else:
+            large[n_large] = g
+            inc(n_large)
+    while n_large > 0:
+        dec(n_large)
+        prob[large[n_large]] = 1
+    while n_small > 0:
+        dec(n_small)
+        prob[small[n_small]] = 1
+
+
+def _sample_topics_alias(int[:] WS, int[:] DS, int[:] ZS, int[:, :] nzw, int[:, :] ndz, int[:] nz,
+                         double[:, :] alpha, double[:] alpha_sum, int[:] alpha_flat,
+                         double[:] eta_floor, int[:] eta_res_ptr, int[:] eta_res_topics, double[:] eta_res,
+                         double[:] eta_sum, uint64_t[:] rng_state, int mh_steps,
+                         double[:] ll_delta=None):
+    """Samples all topic assignments with alias tables and Metropolis-Hastings.
+
+    Each token runs `mh_steps` cycles of a document proposal, drawn in O(1)
+    by picking a random token of the document (or a draw from alpha), and a
+    word proposal, drawn in O(1) from a per-word alias table of
+    (nzw[k, w] + eta[k, w]) / (nz[k] + eta_sum[k]). The word tables are built
+    at the start of the sweep and go stale while sampling. They count every
+    token at the topic it is being moved from, so its own count is taken out
+    of the word proposal: a draw of that topic is kept with probability
+    q_without / q_with, and the acceptance ratio uses q_without. The stale
+    counts of the other tokens still make the proposal depend on the past of
+    the chain, so as in LightLDA the stationary distribution only
+    approximates the exact conditional; more `mh_steps` bring it closer.
+
+    eta and alpha are given as for `_sample_topics_sparse`. A document
+    proposal from a row of alpha that is not flat costs O(n_topics). Tokens
+    must be grouped by document. The generator state `rng_state[0]` is
+    advanced in place and the change of log p(w,z) is added to `ll_delta[0]`.
+
+    Reference: Yuan et al. "LightLDA: Big Topic Models on Modest Computer
+    Clusters." WWW 2015.
+    """
+    cdef int i, j, k, w, d, z, s, t, step, cur_d, start, n_d
+    cdef double u, p_s, p_t, dist_cum, q_z, q_s, q_t
+    cdef double ll_acc = 0
+    cdef bint track_ll = ll_delta is not None
+    cdef int N = WS.shape[0]
+    cdef uint64_t state = rng_state[0]
+    cdef int n_topics = nz.shape[0]
+    cdef int vocab_size = nzw.shape[1]
+    cdef size_t row
+    cdef double* res_buf = <double*> malloc(n_topics * sizeof(double))
+    cdef int* small = <int*> malloc(n_topics * sizeof(int))
+    cdef int* large = <int*> malloc(n_topics * sizeof(int))
+    cdef double* word_q = <double*> malloc(<size_t> vocab_size * n_topics * sizeof(double))
+    cdef double* alias_prob = <double*> malloc(<size_t> vocab_size * n_topics * sizeof(double))
+    cdef int* alias_idx = <int*> malloc(<size_t> vocab_size * n_topics * sizeof(int))
+    cdef int* nz_start = <int*> malloc(n_topics * sizeof(int))
+    cdef char* w_seen = <char*> calloc(vocab_size, sizeof(char))
+    if (res_buf is NULL or small is NULL or large is NULL or word_q is NULL or
+            alias_prob is NULL or alias_idx is NULL or nz_start is NULL or w_seen is NULL):
+        free(res_buf); free(small); free(large)
+        free(word_q); free(alias_prob); free(alias_idx); free(nz_start); free(w_seen)
+        raise MemoryError("Could not allocate memory during sampling.")
+    with nogil:
+        # word proposal tables from the counts at the start of the sweep, only for the
+        # words of these tokens, a thread of the parallel sampler sees a part of the corpus
+        for k in range(n_topics):
+            nz_start[k] = nz[k]
+        for i in range(N):
+            w_seen[WS[i]] = 1
+        for w in range(vocab_size):
+            if not w_seen[w]:
+                continue
+            row = <size_t> w * n_topics
+            for k in range(n_topics):
+                res_buf[k] = 0
+            for j in range(eta_res_ptr[w], eta_res_ptr[w + 1]):
+                res_buf[eta_res_topics[j]] = eta_res[j]
+            for k in range(n_topics):
+                word_q[row + k] = (nzw[k, w] + eta_floor[w] + res_buf[k]) / (nz[k] + eta_sum[k])
+                alias_prob[row + k] = word_q[row + k]
+            _build_alias(alias_prob + row, alias_idx + row, small, large, n_topics)
+        for k in range(n_topics):
+            res_buf[k] = 0
+
+        cur_d = -1
+        start = 0
+        n_d = 0
+        for i in range(N):
+            w = WS[i]
+            d = DS[i]
+            z = ZS[i]
+            row = <size_t> w * n_topics
+
+            if d != cur_d:
+                cur_d = d
+                start = i
+                n_d = 0
+                while start + n_d < N and DS[start + n_d] == d:
+                    inc(n_d)
+
+            dec(nzw[z, w])
+            dec(ndz[d, z])
+            dec(nz[z])
+
+            for j in range(eta_res_ptr[w], eta_res_ptr[w + 1]):
+                res_buf[eta_res_topics[j]] = eta_res[j]
+
+            # word proposal of topic z without this token, which the table counts there
+            q_z = ((word_q[row + z] * (nz_start[z] + eta_sum[z]) - 1) /
+                   (nz_start[z] - 1 + eta_sum[z]))
+
+            s = z
+            for step in range(mh_steps):
+                # document proposal: ndz[d, k] + [k == s] + alpha[d, k], ZS[i] holds s
+                u = uniform(&state) * (n_d + alpha_sum[d])
+                if u < n_d:
+                    t = ZS[start + <int> u]
+                elif alpha_flat[d]:
+                    t = <int> ((u - n_d) / alpha_sum[d] * n_topics)
+                    if t >= n_topics:
+                        t = n_topics - 1
+                else:
+                    u = u - n_d
+                    dist_cum = 0
+                    t = n_topics - 1
+                    for k in range(n_topics):
+                        dist_cum += alpha[d, k]
+                        if u < dist_cum:
+                            t = k
+                            break
+                if t != s:
+                    # the document factors of target and proposal cancel
+                    p_t = (nzw[t, w] + eta_floor[w] + res_buf[t]) / (nz[t] + eta_sum[t])
+                    p_s = (nzw[s, w] + eta_floor[w] + res_buf[s]) / (nz[s] + eta_sum[s])
+                    if uniform(&state) * p_s < p_t:
+                        s = t
+                        ZS[i] = s
+
+                # word proposal from the stale alias table, rejecting the token's own count of z
+                while True:
+                    u = uniform(&state) * n_topics
+                    t = <int> u
+                    if t >= n_topics:
+                        t = n_topics - 1
+                    if u - t >= alias_prob[row + t]:
+                        t = alias_idx[row + t]
+                    if t != z or uniform(&state) * word_q[row + z] < q_z:
+                        break
+                if t != s:
+                    p_t = ((ndz[d, t] + alpha[d, t]) * (nzw[t, w] + eta_floor[w] + res_buf[t]) /
+                           (nz[t] + eta_sum[t]))
+                    p_s = ((ndz[d, s] + alpha[d, s]) * (nzw[s, w] + eta_floor[w] + res_buf[s]) /
+                           (nz[s] + eta_sum[s]))
+                    q_t = q_z if t == z else word_q[row + t]
+                    q_s = q_z if s == z else word_q[row + s]
+                    if uniform(&state) * p_s * q_t < p_t * q_s:
+                        s = t
+                        ZS[i] = s
+
+            if track_ll and s != z:
+                ll_acc += (_ll_enter(eta_floor[w] + res_buf[s], nzw[s, w], eta_sum[s], nz[s],
+                                     alpha[d, s], ndz[d, s]) -
+                           _ll_enter(eta_floor[w] + res_buf[z], nzw[z, w], eta_sum[z], nz[z],
+                                     alpha[d, z], ndz[d, z]))
+            for j in range(eta_res_ptr[w], eta_res_ptr[w + 1]):
+                res_buf[eta_res_topics[j]] = 0
+
+            ZS[i] = s
+            inc(nzw[s, w])
+            inc(ndz[d, s])
+            inc(nz[s])
+
+        rng_state[0] = state
+        if track_ll:
+            ll_delta[0] += ll_acc
+        free(res_buf)
+        free(small)
+        free(large)
+        free(word_q)
+        free(alias_prob)
+        free(alias_idx)
+        free(nz_start)
+        free(w_seen)
+
+
+cdef double _loglikelihood_docs(int[:, :] ndz, int[:] nd, double[:, :] alpha_m, double[:] alpha_sum) nogil:
+    """log p(z), the document part of the complete log likelihood"""
     cdef int k, d
     cdef int D = ndz.shape[0]
     cdef int n_topics = ndz.shape[1]
+
+    cdef double ll = 0
+    cdef double alpha_a = alpha_m[0, 0] if D > 0 and n_topics > 0 else 1
+    cdef double alpha_sum_a = alpha_sum[0] if D > 0 else 1
+    cdef double alpha_table[LGAMMA_TABLE_SIZE]
+    cdef double alpha_sum_table[LGAMMA_TABLE_SIZE]
+
+    _lgamma_table(alpha_a, alpha_table, LGAMMA_TABLE_SIZE)
+    _lgamma_table(alpha_sum_a, alpha_sum_table, LGAMMA_TABLE_SIZE)
+    for d in range(D):
+        if alpha_sum[d] == alpha_sum_a and nd[d] < LGAMMA_TABLE_SIZE:
+            ll -= alpha_sum_table[nd[d]]
+        else:
+            ll += (lgamma(alpha_sum[d]) -
+                    lgamma(alpha_sum[d] + nd[d]))
+        for k in range(n_topics):
+            if ndz[d, k] > 0:
+                if alpha_m[d, k] == alpha_a and ndz[d, k] < LGAMMA_TABLE_SIZE:
+                    ll += alpha_table[ndz[d, k]]
+                else:
+                    ll += lgamma(alpha_m[d, k] + ndz[d, k]) - lgamma(alpha_m[d, k])
+    return ll
+
+
+cpdef double _loglikelihood(int[:, :] nzw, int[:, :] ndz, int[:] nz, int[:] nd, double[:, :] alpha_m, double[:, :] eta_m, double[:] alpha_sum, double[:] eta_sum) nogil:
+    cdef int k, w
+    cdef int n_topics = ndz.shape[1]
     cdef int vocab_size = nzw.shape[1]
 
     cdef double ll = 0
+    # lgamma(a + n) - lgamma(a) for small counts n of the most common prior values,
+    # the entries of flat (symmetric) priors
+    cdef double eta_a = eta_m[0, 0] if n_topics > 0 and vocab_size > 0 else 1
+    cdef double eta_table[LGAMMA_TABLE_SIZE]
 
     # calculate log p(w|z)
     # cdef double lgamma_eta, lgamma_alpha
     with nogil:
+        _lgamma_table(eta_a, eta_table, LGAMMA_TABLE_SIZE)
         # lgamma_eta = lgamma(eta)
         # lgamma_alpha = lgamma(alpha)
 
@@ -99,13 +595,53 @@ cpdef double _loglikelihood(int[:, :] nzw, int[:, :] ndz, int[:] nz, int[:] nd,
             for w in range(vocab_size):
                 # if nzw[k, w] == 0 addition and subtraction cancel out
                 if nzw[k, w] > 0:
-                    ll += lgamma(eta_m[k, w] + nzw[k, w]) - lgamma(eta_m[k, w])
+                    if eta_m[k, w] == eta_a and nzw[k, w] < LGAMMA_TABLE_SIZE:
+                        ll += eta_table[nzw[k, w]]
+                    else:
+                        ll += lgamma(eta_m[k, w] + nzw[k, w]) - lgamma(eta_m[k, w])
 
         # calculate log p(z)
-        for d in range(D):
-            ll += (lgamma(alpha_sum[d]) -
-                    lgamma(alpha_sum[d] + nd[d]))
-            for k in range(n_topics):
-                if ndz[d, k] > 0:
-                    ll += lgamma(alpha_m[d, k] + ndz[d, k]) - lgamma(alpha_m[d, k])
-        return ll
\ No newline at end of file
+        ll += _loglikelihood_docs(ndz, nd, alpha_m, alpha_sum)
+        return ll
+
+
+cpdef double _loglikelihood_sparse(int[:, :] nzw, int[:, :] ndz, int[:] nz, int[:] nd, double[:, :] alpha_m,
+                                   double[:] eta_floor, int[:] eta_res_ptr, int[:] eta_res_words, double[:] eta_res,
+                                   double[:] alpha_sum, double[:] eta_sum) nogil:
+    """`_loglikelihood` with eta given as a per-word floor plus a topic-major sparse residual
+
+    The residual of topic k is eta_res[eta_res_ptr[k]:eta_res_ptr[k + 1]] at
+    the words eta_res_words[eta_res_ptr[k]:eta_res_ptr[k + 1]], sorted
+    (a CSR matrix), so that the dense prior is never built.
+    """
+    cdef int k, w, p, p_end
+    cdef int n_topics = ndz.shape[1]
+    cdef int vocab_size = nzw.shape[1]
+    cdef double eta_kw
+
+    cdef double ll = 0
+    cdef double eta_a = eta_floor[0] if vocab_size > 0 else 1
+    cdef double eta_table[LGAMMA_TABLE_SIZE]
+
+    with nogil:
+        _lgamma_table(eta_a, eta_table, LGAMMA_TABLE_SIZE)
+
+        # calculate log p(w|z)
+        for k in range(n_topics):
+            ll += lgamma(eta_sum[k]) - lgamma(eta_sum[k] + nz[k])
+            p = eta_res_ptr[k]
+            p_end = eta_res_ptr[k + 1]
+            for w in range(vocab_size):
+                eta_kw = eta_floor[w]
+                if p < p_end and eta_res_words[p] == w:
+                    eta_kw += eta_res[p]
+                    inc(p)
+                if nzw[k, w] > 0:
+                    if eta_kw == eta_a and nzw[k, w] < LGAMMA_TABLE_SIZE:
+                        ll += eta_table[nzw[k, w]]
+                    else:
+                        ll += lgamma(eta_kw + nzw[k, w]) - lgamma(eta_kw)
+
+        # calculate log p(z)
+        ll += _loglikelihood_docs(ndz, nd, alpha_m, alpha_sum)
+        return ll
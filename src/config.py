@@ -20,6 +20,11 @@ class Config(object):
     __SEC_PHRASES = "Phrases"
     __SEC_VALIDATE = "ValidateFiles"
     __SEC_VAL = "Validate"
+    __SEC_SAMPLER = "Sampler"
+    __SEC_CONVERGENCE = "Convergence"
+    __SEC_CHECKPOINT = "Checkpoint"
+    __SEC_CACHE = "Cache"
+    __SEC_PREPROCESS = "Preprocess"
 
     @classmethod
     def get_section_list(cls):
@@ -42,8 +47,8 @@ class Config(object):
             elif attr_type is bool:
                 result = cls.Parser.getfloat(section=section, option=option)
             elif attr_type is str:
-                result = cls.Parser.getfloat(section=section, option=option)
-        except configparser.NoOptionError:
+                result = cls.Parser.get(section=section, option=option)
+        except (configparser.NoSectionError, configparser.NoOptionError):
             pass
         return result
 
@@ -87,10 +92,62 @@ class Config(object):
     def get_window_size(cls):
         return cls.__get_attr(int, cls.__SEC_TOPICS, "WindowSize")
 
+    @classmethod
+    def get_prior_top_k(cls):
+        return cls.__get_attr(int, cls.__SEC_TOPICS, "PriorTopK")
+
     @classmethod
     def get_decay_flag(cls):
         return cls.__get_attr(int, cls.__SEC_DECAY, "DecayFlag")
 
+    @classmethod
+    def get_temperature(cls):
+        return cls.__get_attr(float, cls.__SEC_DECAY, "Temperature")
+
+    @classmethod
+    def get_align_topics(cls):
+        return cls.__get_attr(int, cls.__SEC_DECAY, "AlignTopics")
+
+    @classmethod
+    def get_sampler(cls):
+        return cls.__get_attr(str, cls.__SEC_SAMPLER, "Sampler")
+
+    @classmethod
+    def get_n_jobs(cls):
+        return cls.__get_attr(int, cls.__SEC_SAMPLER, "Jobs")
+
+    @classmethod
+    def get_warm_start(cls):
+        return cls.__get_attr(int, cls.__SEC_SAMPLER, "WarmStart")
+
+    @classmethod
+    def get_refresh(cls):
+        return cls.__get_attr(int, cls.__SEC_CONVERGENCE, "Refresh")
+
+    @classmethod
+    def get_tol(cls):
+        return cls.__get_attr(float, cls.__SEC_CONVERGENCE, "Tol")
+
+    @classmethod
+    def get_min_iter(cls):
+        return cls.__get_attr(int, cls.__SEC_CONVERGENCE, "MinIter")
+
+    @classmethod
+    def get_conv_window(cls):
+        return cls.__get_attr(int, cls.__SEC_CONVERGENCE, "Window")
+
+    @classmethod
+    def get_checkpoint(cls):
+        return cls.__get_attr(int, cls.__SEC_CHECKPOINT, "Checkpoint")
+
+    @classmethod
+    def get_token_cache(cls):
+        return cls.__get_attr(str, cls.__SEC_CACHE, "TokenCache")
+
+    @classmethod
+    def get_workers(cls):
+        return cls.__get_attr(int, cls.__SEC_PREPROCESS, "Workers")
+
     @classmethod
     def get_bigram_min(cls):
         return cls.__get_attr(int, cls.__SEC_PHRASES, "Bigram_Min")
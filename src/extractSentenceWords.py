@@ -19,6 +19,41 @@ unicode_punc_tbl = dict.fromkeys( i for i in xrange(128, sys.maxunicode)
                       if unicodedata.category(unichr(i)).startswith('P') )
 
 
+class LemmaCache(object):
+    """
+    Bounded memo of WordNetLemmatizer.lemmatize, shared by all calls of extractSentenceWords
+
+    Words are Zipf distributed, so most lookups repeat; the cache is emptied
+    when it reaches maxsize. hits and misses count the lookups answered from
+    the cache and from WordNet.
+    """
+    def __init__(self, maxsize=200000):
+        self.maxsize = maxsize
+        self.wnl = WordNetLemmatizer()
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lemmatize(self, word, pos='n'):
+        key = (word, pos)
+        lemma = self.cache.get(key)
+        if lemma is not None:
+            self.hits += 1
+            return lemma
+        self.misses += 1
+        lemma = self.wnl.lemmatize(word, pos)
+        if len(self.cache) >= self.maxsize:
+            self.cache.clear()
+        self.cache[key] = lemma
+        return lemma
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+lemma_cache = LemmaCache()
+
+
 # def lemmatize(word):
 #     if word in skip_words:
 #         return word
@@ -29,50 +64,110 @@ unicode_punc_tbl = dict.fromkeys( i for i in xrange(128, sys.maxunicode)
 #             n_word = temp_token
 #     return n_word
 
-def extractSentenceWords(doc, remove_url=True, remove_punc="utf-8", min_length=1, lemma=False, sent=True, replace_digit=False):
-    if remove_punc:
-        # ensure doc_u is in unicode
-        if not isinstance(doc, unicode):
-            encoding = remove_punc
-            doc_u = doc.decode(encoding)
-        else:
-            doc_u = doc
-        # remove unicode punctuation marks, keep ascii punctuation marks
-        doc_u = doc_u.translate(unicode_punc_tbl)
-        if not isinstance(doc, unicode):
-            doc = doc_u.encode(encoding)
-        else:
-            doc = doc_u
-
-    if remove_url:
-        re_url = r"(https?:\/\/)?(www\.)?[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)"
-        doc = re.sub( re_url, "", doc )
-
-    sentences = re.split( r"\s*[;:`\"()?!{}]\s*|--+|\s*-\s+|''|\.\s|\.$|\.\.+|��|��", doc )  # comment comma
-    wc = 0
-    wordsInSentences = []
-    wnl = WordNetLemmatizer()
-    for sentence in sentences:
-        if sentence == "":
-            continue
-
-        if not re.search( "[A-Za-z0-9]", sentence ):
-            continue
-
-        # words = re.split( r"\s+\+|^\+|\+?[\-*\/&%=_<>\[\]~\|\@\$]+\+?|\'\s+|\'s\s+|\'s$|\s+\'|^\'|\'$|\$|\\|\s+", sentence )
-        words = re.split(r"[\s+,\-*\/&%=_<>\[\]~\|\@\$\\]",
-                         sentence)
-        words = filter( lambda w: w, words)
-        words = map(lambda w: w.lower(), words)
-        if replace_digit:
-            map(lambda w: re.sub(r'\d+', '<digit>', w), words)
-        if lemma:
-            words = map(lambda w: wnl.lemmatize(w, 'v'), words)
-        if len(words) >= min_length:
-            wordsInSentences.append(words)
-            wc += len(words)
-    if not sent:
-        return list(itertools.chain.from_iterable(wordsInSentences)), wc
-    return wordsInSentences, wc
+# split points between sentences, and between words inside a sentence
+URL_PATTERN = r"(https?:\/\/)?(www\.)?[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)"
+SENTENCE_PATTERN = r"\s*[;:`\"()?!{}]\s*|--+|\s*-\s+|''|\.\s|\.$|\.\.+|��|��"  # comment comma
+WORD_PATTERN = r"[\s+,\-*\/&%=_<>\[\]~\|\@\$\\]"
+
+
+class SentenceTokenizer(object):
+    """
+    extractSentenceWords with its options fixed and its patterns compiled once
+
+    Sentences and words are split in one scan of the document: the sentence
+    pattern is tried first at every position, as re.split on the sentences
+    would, and a word delimiter only separates words, so the pieces between
+    two sentence delimiters are exactly the words of that sentence.
+    """
+    def __init__(self, remove_url=True, remove_punc="utf-8", min_length=1, lemma=False, sent=True,
+                 replace_digit=False):
+        self.remove_url = remove_url
+        self.remove_punc = remove_punc
+        self.min_length = min_length
+        self.lemma = lemma
+        self.sent = sent
+        # kept for the signature only, extractSentenceWords has never applied it to its output
+        self.replace_digit = replace_digit
+        self.url_re = re.compile(URL_PATTERN)
+        # every url has a dot followed by a lower case top level domain, most reviews have none
+        self.url_hint_re = re.compile(r"\.[a-z]{2}")
+        # the punctuation removed is all outside ascii, so ascii documents are left as they are, provided the
+        # encoding maps ascii onto itself
+        self.non_ascii_re = re.compile(u"[^\x00-\x7f]")
+        ascii_chars = u"".join(unichr(i) for i in xrange(128))
+        self.ascii_encoding = not remove_punc or ascii_chars.encode(remove_punc) == ascii_chars.encode("ascii")
+        # the group is set when a sentence delimiter matched, None for a word delimiter
+        self.split_re = re.compile("(%s)|%s" % (SENTENCE_PATTERN, WORD_PATTERN))
+        self.alnum_re = re.compile("[A-Za-z0-9]")
 
+    def __call__(self, doc):
+        """
+        :param doc: document, byte string or unicode
+        :return: (wordsInSentences, wc) as extractSentenceWords returns them
+        """
+        if self.remove_punc and (self.non_ascii_re.search(doc) or not self.ascii_encoding):
+            # ensure doc_u is in unicode
+            if not isinstance(doc, unicode):
+                encoding = self.remove_punc
+                doc_u = doc.decode(encoding)
+            else:
+                doc_u = doc
+            # remove unicode punctuation marks, keep ascii punctuation marks
+            doc_u = doc_u.translate(unicode_punc_tbl)
+            if not isinstance(doc, unicode):
+                doc = doc_u.encode(encoding)
+            else:
+                doc = doc_u
 
+        if self.remove_url and self.url_hint_re.search(doc):
+            doc = self.url_re.sub("", doc)
+
+        # neither split pattern involves letters, lowering the whole document equals lowering every word
+        pieces = self.split_re.split(doc.lower())
+        # pieces alternate word, delimiter group, word, ..., and end with a word
+        tokens = pieces[0::2]
+        ends = [i + 1 for i, group in enumerate(pieces[1::2]) if group is not None]
+        ends.append(len(tokens))
+        alnum_search = self.alnum_re.search
+        lemmatize = lemma_cache.lemmatize
+        wc = 0
+        wordsInSentences = []
+        start = 0
+        for end in ends:
+            words = filter(None, tokens[start:end])
+            start = end
+            # sentences without a letter or digit are skipped
+            if not words or not alnum_search(" ".join(words)):
+                continue
+            if self.lemma:
+                words = [lemmatize(w, 'v') for w in words]
+            if len(words) >= self.min_length:
+                wordsInSentences.append(words)
+                wc += len(words)
+        if not self.sent:
+            return list(itertools.chain.from_iterable(wordsInSentences)), wc
+        return wordsInSentences, wc
+
+    def tokenize_many(self, docs):
+        """
+        :param docs: iterable of documents
+        :return: list of the (wordsInSentences, wc) of every document, in order
+        """
+        return [self(doc) for doc in docs]
+
+
+_tokenizers = {}
+
+
+def get_tokenizer(**options):
+    """SentenceTokenizer for the given extractSentenceWords options, built once per distinct options"""
+    key = tuple(sorted(options.items()))
+    tokenizer = _tokenizers.get(key)
+    if tokenizer is None:
+        tokenizer = _tokenizers[key] = SentenceTokenizer(**options)
+    return tokenizer
+
+
+def extractSentenceWords(doc, remove_url=True, remove_punc="utf-8", min_length=1, lemma=False, sent=True, replace_digit=False):
+    return get_tokenizer(remove_url=remove_url, remove_punc=remove_punc, min_length=min_length, lemma=lemma,
+                         sent=sent, replace_digit=replace_digit)(doc)
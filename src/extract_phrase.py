@@ -3,21 +3,22 @@ from gensim.models.phrases import Phrases
 import os
 import itertools
 from extractSentenceWords import *
+from token_cache import tokenize_docs
 
 logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s', level=logging.INFO)
 
 
-def build_input(app_files):
+def build_input(app_files, cache_dir=None, n_workers=1):
     doc_sent_word = []
     num_words = 0
     num_docs = 0
     for app, path in app_files:
         l_id = 0
         with open(path) as fin:
-            for line in fin.readlines():
-                line = line.strip()
-                line = line.split("******")
-                words_sents, wc = extractSentenceWords(line[1], lemma=True)
+            lines = [line.strip().split("******") for line in fin.readlines()]
+            tokens = tokenize_docs([line[1] for line in lines], cache_dir, n_workers, lemma=True)
+            for line in lines:
+                words_sents, wc = tokens[l_id]
                 doc_sent_word.append(words_sents)
                 num_docs += 1
                 num_words += wc
@@ -25,14 +26,18 @@ def build_input(app_files):
                     logging.info("processed %d docs of %s" % (l_id, app))
                 l_id += 1
     logging.info("Read %d docs, %d words!" % (num_docs, num_words))
+    # the counters only see the lookups of this process, none when the docs came from the token cache or the workers
+    if lemma_cache.hits + lemma_cache.misses:
+        logging.info("lemma cache: %d hits, %d misses, hit rate %.3f" %
+                     (lemma_cache.hits, lemma_cache.misses, lemma_cache.hit_rate()))
     return doc_sent_word
 
 ### write bigrams and trigrams to .model files
-def extract_phrases(app_files, bigram_min, trigram_min):
+def extract_phrases(app_files, bigram_min, trigram_min, cache_dir=None, n_workers=1):
     bigram_fp = os.path.join("..", "model", "bigram.model")
     trigram_fp = os.path.join("..", "model", "trigram.model")
 
-    rst = build_input(app_files)
+    rst = build_input(app_files, cache_dir, n_workers)
     gen = list(itertools.chain.from_iterable(rst))  # flatten
     bigram = Phrases(gen, threshold=5, min_count=bigram_min)
     trigram = Phrases(bigram[gen], threshold=3, min_count=trigram_min)
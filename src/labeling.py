@@ -0,0 +1,256 @@
+"""
+Corpus statistics of the topic labeling
+
+The text of every time slice is turned into word ids once, in a SliceStats,
+and the label and sentence scorers of topic_labeling compute the counts they
+need from its arrays, instead of running doc2bow over the sentences again
+for each of them. The labels of a slice are looked up in a LabelIndex.
+"""
+import numbers
+import numpy as np
+from scipy import sparse
+
+
+def _ranges(starts, lengths):
+    """Indices starts[0], ..., starts[0] + lengths[0] - 1, starts[1], ... of the concatenated ranges"""
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - lengths), lengths)
+
+
+class LabelIndex(object):
+    """Labels of a time slice, numbered by row
+
+    rows is a dense array over the vocabulary with the row of every label
+    and -1 for the other words, so that telling labels apart and finding
+    their rows are array lookups instead of scans of the list of label ids.
+    Indexing, len(), `in` and index() work as on that list.
+    """
+
+    def __init__(self, label_ids, n_words):
+        self.label_ids = np.asarray(label_ids, dtype=np.int64)     # word id of the label of each row
+        self.rows = np.full(n_words, -1, dtype=np.int32)
+        self.rows[self.label_ids] = np.arange(len(self.label_ids))
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def __getitem__(self, row):
+        return int(self.label_ids[row])
+
+    def __contains__(self, word_id):
+        # like `in` on the list, False for None and ids outside the vocabulary
+        if not isinstance(word_id, numbers.Integral) or not 0 <= word_id < len(self.rows):
+            return False
+        return self.rows[word_id] >= 0
+
+    @property
+    def n_words(self):
+        return len(self.rows)
+
+    def row(self, word_id):
+        """Row of a label, -1 for a word that is no label"""
+        return int(self.rows[word_id])
+
+    def index(self, word_id):
+        """Row of a label, ValueError for anything else as list.index raises"""
+        if word_id not in self:
+            raise ValueError("%r is not a label" % (word_id,))
+        return int(self.rows[word_id])
+
+    def isin(self, word_ids):
+        """Mask of the word ids that are labels"""
+        return self.rows[word_ids] >= 0
+
+
+class SliceStats(object):
+    """Word ids, sentences and docs of a time slice, from one pass over its text
+
+    Sentences are numbered through all slices as in the flattened list of
+    sentences of topic_labeling, the first sentence of this slice having
+    number sent_base.
+    """
+
+    def __init__(self, n_words, tokens, sent_offsets, sent_lengths, doc_offsets, rates, views=None, sent_base=0):
+        self.n_words = n_words              # size of the vocabulary
+        self.tokens = tokens                # word ids of the known words, one sentence after another
+        self.sent_offsets = sent_offsets    # sentence j is tokens[sent_offsets[j]:sent_offsets[j + 1]]
+        self.sent_lengths = sent_lengths    # number of words of every sentence, unknown words included
+        self.doc_offsets = doc_offsets      # doc i is sentences doc_offsets[i] to doc_offsets[i + 1] - 1
+        self.rates = rates                  # rate of every doc
+        self.views = views                  # views of every doc, None when unknown
+        self.sent_base = sent_base
+        self.total_count = len(tokens)      # number of known words
+
+    @classmethod
+    def build(cls, dictionary, rawinput_i, rates_i, views_i=None, sent_base=0):
+        """
+        :param dictionary: Vocabulary, the words unknown to it are left out as doc2bow does
+        :param rawinput_i: list of docs, each a list of sentences
+        :param rates_i: rate of every doc
+        :param views_i: views of every doc
+        :param sent_base: number of the first sentence
+        """
+        token2id = dictionary.token2id
+        tokens = []
+        sent_offsets = [0]
+        sent_lengths = []
+        doc_offsets = [0]
+        for doc in rawinput_i:
+            for sentence in doc:
+                tokens.extend(token2id[w] for w in sentence if w in token2id)
+                sent_offsets.append(len(tokens))
+                sent_lengths.append(len(sentence))
+            doc_offsets.append(len(sent_lengths))
+        return cls(len(dictionary), np.array(tokens, dtype=np.int64), np.array(sent_offsets, dtype=np.int64),
+                   np.array(sent_lengths, dtype=np.int64), np.array(doc_offsets, dtype=np.int64),
+                   np.asarray(rates_i, dtype=float), None if views_i is None else np.asarray(views_i, dtype=float),
+                   sent_base)
+
+    @property
+    def n_sents(self):
+        return len(self.sent_lengths)
+
+    def sent_docs(self):
+        """Doc of every sentence"""
+        return np.repeat(np.arange(len(self.doc_offsets) - 1), np.diff(self.doc_offsets))
+
+    def doc_lengths(self):
+        """Number of words of every doc, unknown words included"""
+        ends = np.concatenate(([0], np.cumsum(self.sent_lengths)))
+        return ends[self.doc_offsets[1:]] - ends[self.doc_offsets[:-1]]
+
+    def label_docs(self, labels):
+        """
+        Docs containing each label
+        :param labels: LabelIndex
+        :return: (docs, rows), every doc and row of a label in it once
+        """
+        token_docs = np.repeat(self.sent_docs(), np.diff(self.sent_offsets))
+        rows = labels.rows[self.tokens]
+        hits = rows >= 0
+        keys = np.unique(token_docs[hits] * len(labels) + rows[hits])
+        return keys // len(labels), keys % len(labels)
+
+    def sentence_freqs(self, sent_ids):
+        """
+        Relative frequencies n(s, w) / len(s) of the words of sentences, unknown words counting in len(s)
+        :param sent_ids: numbers of sentences of this slice
+        :return: csr_matrix with a row per sentence and a column per word
+        """
+        local = np.asarray(sent_ids, dtype=np.int64) - self.sent_base
+        starts = self.sent_offsets[local]
+        lengths = self.sent_offsets[local + 1] - starts
+        rows = np.repeat(np.arange(len(local)), lengths)
+        # the duplicates of a word are summed up to n(s, w)
+        freqs = sparse.csr_matrix((np.ones(len(rows)), (rows, self.tokens[_ranges(starts, lengths)])),
+                                  shape=(len(local), self.n_words))
+        freqs.data /= np.repeat(self.sent_lengths[local], np.diff(freqs.indptr))
+        return freqs
+
+
+def floored_log_dot(weights, freqs, floor):
+    """
+    weights . log(F)^T for the dense F that equals freqs where it is stored and floor elsewhere, without forming F
+    :param weights: array with a row per topic and a column per word
+    :param freqs: csr_matrix with a row per sentence and a column per word, see SliceStats.sentence_freqs
+    :param floor: value of the cells not stored
+    :return: array with a row per topic and a column per sentence
+    """
+    # log(F) = log(floor) + (log(freqs) - log(floor)) on the stored cells, 0 elsewhere
+    excess = freqs.copy()
+    excess.data = np.log(excess.data) - np.log(floor)
+    return np.log(floor) * np.sum(weights, 1, keepdims=True) + excess.dot(np.transpose(weights)).T
+
+
+def slice_stats(dictionary, rawinput, rates, views=None):
+    """
+    SliceStats of every time slice
+    :param dictionary: Vocabulary
+    :param rawinput: list of slices, each a list of docs
+    :param rates: rates of the docs of every slice
+    :param views: views of the docs of every slice, None when unknown
+    :return: list of SliceStats
+    """
+    stats = []
+    sent_base = 0
+    for t_i, rawinput_i in enumerate(rawinput):
+        stats.append(SliceStats.build(dictionary, rawinput_i, rates[t_i], None if views is None else views[t_i],
+                                      sent_base))
+        sent_base += stats[-1].n_sents
+    return stats
+
+
+class CoOccurrence(object):
+    """Word counts and label-word co-occurrence counts of a time slice
+
+    n(w) is the number of occurrences of word w. n(l, w) sums over the
+    sentences that contain label l the smaller of the numbers of l and of w
+    in the sentence, n(l, l) being the occurrences of l in those sentences.
+    """
+
+    def __init__(self, labels, word_counts, pairs):
+        self.labels = labels                # LabelIndex of the rows
+        self.word_counts = word_counts      # n(w) for every word id
+        self.pairs = pairs                  # csr_matrix of n(l, w), one row per label
+
+    @classmethod
+    def build(cls, tokens, sent_offsets, labels):
+        """
+        :param tokens: word ids of all sentences of the slice, one sentence after another
+        :param sent_offsets: sentence j is tokens[sent_offsets[j]:sent_offsets[j + 1]]
+        :param labels: LabelIndex of the labels
+        """
+        n_words = labels.n_words
+        tokens = np.asarray(tokens, dtype=np.int64)
+        sent_lengths = np.diff(sent_offsets)
+        n_sents = len(sent_lengths)
+        word_counts = np.bincount(tokens, minlength=n_words)
+        # bag of words of every sentence: its distinct words, ordered by sentence, with their numbers
+        keys, bow_counts = np.unique(np.repeat(np.arange(n_sents), sent_lengths) * n_words + tokens,
+                                     return_counts=True)
+        bow_sents = keys // n_words
+        bow_words = keys % n_words
+        bow_lengths = np.bincount(bow_sents, minlength=n_sents)
+        bow_starts = np.cumsum(bow_lengths) - bow_lengths
+        # pair every label entry with all entries of its sentence
+        rows = labels.rows[bow_words]
+        hits = np.flatnonzero(rows >= 0)
+        lengths = bow_lengths[bow_sents[hits]]
+        entries = _ranges(bow_starts[bow_sents[hits]], lengths)
+        pairs = sparse.coo_matrix((np.minimum(np.repeat(bow_counts[hits], lengths), bow_counts[entries]),
+                                   (np.repeat(rows[hits], lengths), bow_words[entries])),
+                                  shape=(len(labels), n_words)).tocsr()
+        return cls(labels, word_counts, pairs)
+
+    def pair_counts(self, label_id):
+        """n(label_id, w) for every word id, zeros when label_id is no label of the slice"""
+        row = self.labels.row(label_id)
+        if row < 0:
+            return np.zeros(len(self.word_counts), dtype=self.pairs.dtype)
+        return self.pairs[row].toarray().ravel()
+
+    def pmi(self, total_count, labels=None, by_label=True):
+        """
+        Log pointwise mutual information log(n(l, w) * N / ((n(w) + 1) * (n(l) + 1))) of the co-occurring labels and words
+        :param total_count: number of words N of the slice
+        :param labels: LabelIndex of the rows, the labels of the slice by default; labels that are not among them get
+        empty rows
+        :param by_label: False for dividing by (n(w) + 1) ** 2 instead, as topic_detect does for the newer slice
+        :return: csr_matrix with a row per label and a column per word, 0 = log 1 where n(l, w) = 0
+        """
+        pairs = self.pairs.tocoo()
+        rows, cols = pairs.row, pairs.col
+        label_ids = self.labels.label_ids[rows]
+        word_counts = self.word_counts.astype(float)
+        if by_label:
+            denominators = (word_counts[cols] + 1) * (word_counts[label_ids] + 1)
+        else:
+            denominators = (word_counts[cols] + 1) * (word_counts[cols] + 1)
+        values = np.log(pairs.data * float(total_count) / denominators)
+        if labels is None:
+            labels = self.labels
+        elif labels is not self.labels:
+            rows = labels.rows[label_ids]
+            keep = rows >= 0
+            rows, cols, values = rows[keep], cols[keep], values[keep]
+        return sparse.csr_matrix((values, (rows, cols)), shape=(len(labels), len(self.word_counts)))
@@ -15,15 +15,18 @@ import re
 import numpy as np
 from scipy import sparse
 from scipy.stats import entropy
+from scipy.special import xlogy
 from datetime import datetime, timedelta
 import nltk
 from nltk.corpus import stopwords
-from gensim import corpora
 from collections import defaultdict
 from gensim.models import Word2Vec, LdaMulticore, TfidfModel
 from extractSentenceWords import *
 from onlineLDA import *
 from config import Config
+from vocabulary import Vocabulary
+from token_cache import tokenize_docs, parallel_imap
+from labeling import LabelIndex, CoOccurrence, slice_stats, floored_log_dot
 from extract_phrase import extract_phrases
 import random
 
@@ -53,6 +56,19 @@ info_num = Config.get_info_num()
 store_num = Config.get_store_num()
 val_index = Config.get_validate_or_not()
 decay_flag = Config.get_decay_flag()
+temperature = Config.get_temperature() or 1.0
+align_topics = bool(Config.get_align_topics())
+prior_top_k = Config.get_prior_top_k()
+sampler = Config.get_sampler() or 'dense'
+n_jobs = Config.get_n_jobs() or 1
+warm_start = bool(Config.get_warm_start())
+refresh = Config.get_refresh() or 500
+tol = Config.get_tol()
+min_iter = Config.get_min_iter() or 0
+conv_window = Config.get_conv_window() or 5
+checkpoint = bool(Config.get_checkpoint())
+token_cache = Config.get_token_cache()
+n_workers = Config.get_workers() or 1
 
 
 def extract_review():
@@ -67,6 +83,11 @@ def extract_review():
         timed_reviews[apk] = []
         with open(app) as fin:
             lines = fin.readlines()
+        # tokenise the well-formed reviews in one go, read from the token cache if seen before
+        all_terms = [line.strip().split("******") for line in lines]
+        tokens = tokenize_docs([terms[1] for terms in all_terms if len(terms) == info_num], token_cache, n_workers)
+        # phrases and digits are applied by the worker processes, the reviews come back in order
+        reviews = parallel_imap(phrase_review, (tokens[d_id] for d_id in xrange(len(tokens))), n_workers)
         for l_id, line in enumerate(lines):
             line = line.strip()
             terms = line.split("******")
@@ -79,10 +100,7 @@ def extract_review():
             else:             ## for android
                 date = terms[2]
                 version = terms[3]
-            review_o = terms[1]
-            review_p, wc = extractSentenceWords(review_o) #[['what', 'problem', 'of', 'ai', 'be', 'not', 'machine', 'be', 'difference', 'between', 'ai', 'and', 'machine', 'problem', 'handle', 'both', 'ai', 'and', 'machine', 'learning']]    20
-            review = list(build_phrase(review_p))
-            review = [list(replace_digit(s)) for s in review]   #review  sentence in different list
+            review, wc = next(reviews)   #review  sentence in different list
             rate = float(terms[0]) if re.match(r'\d*\.?\d+', terms[0]) else 2.0  # 2.0 is the average rate
             timed_reviews[apk].append({"review": review, "date": date, "rate": rate, "version": version})
             num_docs += 1
@@ -92,6 +110,16 @@ def extract_review():
     logging.info("total read %d reviews, %d words."%(num_docs, num_words))
     return timed_reviews
 
+def phrase_review(tokenised):
+    """
+    Apply the phrase models and replace digits in a tokenised review
+    :param tokenised: (wordsInSentences, wc) of the review, e.g. ([['what', 'problem', 'of', 'ai', 'be', 'not', 'machine', 'be', 'difference', 'between', 'ai', 'and', 'machine', 'problem', 'handle', 'both', 'ai', 'and', 'machine', 'learning']], 20)
+    :return: (review, wc), review being a list of sentences
+    """
+    review_p, wc = tokenised
+    review = list(build_phrase(review_p))
+    return [list(replace_digit(s)) for s in review], wc
+
 def replace_digit(sent):
     for w in sent:
         if w.isdigit():
@@ -112,14 +140,17 @@ def update_phrase():
     for apk, app in app_files:
         with open(app) as fin:
             lines = fin.readlines()
+        all_terms = [line.strip().split("******") for line in lines]
+        tokens = tokenize_docs([terms[1] for terms in all_terms if len(terms) == info_num], token_cache, n_workers)
+        d_id = 0
         for line in lines:
             line = line.strip()
             terms = line.split("******")
             if len(terms) != info_num:
                 logging.error("review format error at %s in %s" % (apk, line))
                 continue
-            review_o = terms[1]
-            review_p, wc = extractSentenceWords(review_o)
+            review_p, wc = tokens[d_id]
+            d_id += 1
             bigram.add_vocab(review_p)
             trigram.add_vocab(bigram[review_p])
         # update
@@ -181,13 +212,8 @@ def build_AOLDA_input_version(timed_reviews=None):
                 input.append(version_dict[ver][0])
                 rate.append(version_dict[ver][1])
 
-        dict_input = list(itertools.chain.from_iterable(list(itertools.chain.from_iterable(input))))
-        #print(dict_input)
-        dictionary = corpora.Dictionary(dict_input)
-        dictionary.filter_tokens(map(dictionary.token2id.get, stoplist))
-        dictionary.compactify()
-        dictionary.filter_extremes(no_below=5, keep_n=10000)
-        dictionary.compactify()
+        # the vocabulary grows with every slice, the ids of earlier slices never change
+        dictionary = Vocabulary(no_below=5, no_above=0.5, keep_n=10000, bad_tokens=stoplist)
 
         # for each interval, build bow
         input_X = []
@@ -203,6 +229,7 @@ def build_AOLDA_input_version(timed_reviews=None):
         #        paramter.append(int(3))
         #f.close()
         for t_i, text_period in enumerate(input):
+            dictionary.add_documents(itertools.chain.from_iterable(text_period))
             # construct sparse matrix
             #text_period = list(itertools.chain.from_iterable(text_period))      # sentence level to doc level
             for temp in text_period:
@@ -279,9 +306,14 @@ def OLDA_fit(OLDA_input, n_topics, win_size):
     for apk, item in OLDA_input.items():
         dictionary, input_X, _, _1, _2 = item
         #print(input_X)
-        olda_model = OLDA(n_topics=n_topics, n_iter=1000, refresh=500, window_size=win_size)
-        olda_model.fit(input_X, decay_flag, 1)
-        phis[apk] = olda_model.B
+        olda_model = OLDA(n_topics=n_topics, n_iter=1000, refresh=refresh, window_size=win_size,
+                          sampler=sampler, warm_start=warm_start, tol=tol, min_iter=min_iter,
+                          conv_window=conv_window, n_jobs=n_jobs, temperature=temperature,
+                          align_topics=align_topics, prior_top_k=prior_top_k)
+        checkpoint_dir = "../model/olda_%s_%s_%s"%(apk, n_topics, win_size) if checkpoint else None
+        olda_model.fit(input_X, decay_flag, 1, checkpoint_dir=checkpoint_dir)
+        # pad the phis of the earlier slices to the final vocabulary, the words they never saw with probability 0
+        phis[apk] = [np.pad(phi, ((0, 0), (0, len(dictionary) - phi.shape[1])), 'constant') for phi in olda_model.B]
         theta[apk] = olda_model.A
         fout = open("../result/topic_words_%s_%s_%s"%(apk, n_topics, win_size), 'w')
         for t_i, phi in enumerate(phis[apk]):
@@ -293,61 +325,30 @@ def OLDA_fit(OLDA_input, n_topics, win_size):
         fout.close()
     return phis
 
-def count_occurence(dic, rawinput, label_ids):
+def count_occurence(stats, label_ids):
     count = []
-    for d_i, rawinput_i in enumerate(rawinput):
-        count_i = defaultdict(int)
-        for input in list(itertools.chain.from_iterable(rawinput_i)):
-            bow = dic.doc2bow(input)
-            for id, value in bow:
-                count_i[id] += value
-                if id in label_ids[d_i]:
-                    for idx, valuex in bow:
-                        count_i[id, idx] += min(value, valuex)    # label always first
-        count.append(count_i)
+    for d_i, stats_i in enumerate(stats):
+        count.append(CoOccurrence.build(stats_i.tokens, stats_i.sent_offsets, label_ids[d_i]))
     return count
 
-def total_count_(dic, rawinput):
-    total_count = []
-    for rawinput_i in rawinput:
-        total_count_i = 0
-        for input in list(itertools.chain.from_iterable(rawinput_i)):
-            bow = dic.doc2bow(input)
-            for id, value in bow:
-                total_count_i += value
-        total_count.append(total_count_i)
-    return total_count
-
-def get_candidate_label_ids(dic, labels, rawinput):
-    all_label_ids = map(dic.token2id.get, labels)
-    label_ids = []
+def total_count_(stats):
+    return [stats_i.total_count for stats_i in stats]
 
-    for rawinput_i in rawinput:
-        count = defaultdict(int)
-        for input in list(itertools.chain.from_iterable(rawinput_i)):
-            bow = dic.doc2bow(input)
-            for id, value in bow:
-                if id in all_label_ids:
-                    count[id] += value
-        label_ids.append(count.keys())
+def get_candidate_label_ids(dic, labels, stats):
+    all_labels = LabelIndex([id for id in map(dic.token2id.get, labels) if id is not None], len(dic))
+    label_ids = []
+    for stats_i in stats:
+        # the labels occurring in the slice
+        label_ids.append(LabelIndex(np.unique(stats_i.tokens[all_labels.isin(stats_i.tokens)]), len(dic)))
     return label_ids
 
-def get_candidate_sentences_ids(rawinput, rates):
+def get_candidate_sentences_ids(stats):
     sent_ids = []
     sent_rates = []
-    index = 0
-    for t_i, rawinput_i in enumerate(rawinput):
-        sent_id = []
-        sent_rate = []
-        for i_d, input_d in enumerate(rawinput_i):
-            for i_s, input_s in enumerate(input_d):
-                if len(input_s) < 5:          # length should be bigger than 5
-                    continue
-                sent_id.append(index + i_s)
-                sent_rate.append(rates[t_i][i_d])
-            index += len(input_d)
-        sent_ids.append(sent_id)
-        sent_rates.append(sent_rate)
+    for stats_i in stats:
+        sent_id = np.flatnonzero(stats_i.sent_lengths >= 5)          # length should be bigger than 5
+        sent_ids.append(stats_i.sent_base + sent_id)
+        sent_rates.append(stats_i.rates[stats_i.sent_docs()[sent_id]])
     #print(sent_rates)
     print(len(sent_rates))  #3
     print(len(sent_rates[0]))   #1458
@@ -355,23 +356,16 @@ def get_candidate_sentences_ids(rawinput, rates):
     print(len(sent_rates[2]))   #1742
     return sent_ids, sent_rates
 
-def get_sensitivities(dic, rawinput, rates, label_ids):
+def get_sensitivities(stats, label_ids):
     sensi = []
-    for t_i, rawinput_i in enumerate(rawinput): #3 loops since 3 versions
-        sensi_t = []
-        label_sensi = [[] for _ in label_ids[t_i]]
-        for d_i, input in enumerate(rawinput_i):
-            doc_input = list(itertools.chain.from_iterable(input))
-            bow = dic.doc2bow(doc_input)
-            for id, value in bow:
-                if id in label_ids[t_i]:
-                    label_sensi[label_ids[t_i].index(id)].append([rates[t_i][d_i], len(doc_input)]) # record the rate and length
-        for rl in label_sensi:
-            rl = np.array(rl)
-            m_rl = np.mean(rl, 0)
-            sensi_t.append(np.exp(- m_rl[0]/np.log(1+m_rl[1])))
-            #sensi_t.append(np.exp(- m_rl[0]))
-        sensi.append(np.array(sensi_t))
+    for t_i, stats_i in enumerate(stats): #3 loops since 3 versions
+        # mean rate and length of the docs containing each label
+        docs, rows = stats_i.label_docs(label_ids[t_i])
+        n_docs = np.bincount(rows, minlength=len(label_ids[t_i]))
+        m_rate = np.bincount(rows, stats_i.rates[docs], len(label_ids[t_i])) / n_docs
+        m_len = np.bincount(rows, stats_i.doc_lengths()[docs], len(label_ids[t_i])) / n_docs
+        sensi.append(np.exp(- m_rate/np.log(1+m_len)))
+        #sensi.append(np.exp(- m_rate))
     #print(sensi)
     #print(len(sensi))
     #print(sensi[0].shape)   #(57,)
@@ -379,15 +373,11 @@ def get_sensitivities(dic, rawinput, rates, label_ids):
     #print(sensi[2].shape)   #(67,)
     return sensi
 
-def get_sensitivities_sent(rawinput_sent, sent_rates, sent_ids):
+def get_sensitivities_sent(stats, sent_rates, sent_ids):
     sensi = []
     for t_i, sent_id in enumerate(sent_ids):
-        sensi_i = []
-        for id, s_id in enumerate(sent_id):
-            r = sent_rates[t_i][id]
-            l = len(rawinput_sent[s_id])
-            sensi_i.append(np.exp(- r / float(np.log(l))))
-        sensi.append(np.array(sensi_i))
+        l = stats[t_i].sent_lengths[sent_id - stats[t_i].sent_base]
+        sensi.append(np.exp(- sent_rates[t_i] / np.log(l)))
     return sensi
 
 
@@ -403,7 +393,7 @@ def JSD(P, Q):
 
 def sim_topic_word(phi, label_id, count):
     # sim = 0
-    c_l = np.array([np.log((count[label_id, w_id] + 1) / float((count[w_id] + 1) * (count[label_id] + 1))) for w_id in range(len(phi))])
+    c_l = np.log((count.pair_counts(label_id)[:len(phi)] + 1) / ((count.word_counts[:len(phi)] + 1) * float(count.word_counts[label_id] + 1)))
     return np.dot(phi, c_l)
 
 def topic_labeling(OLDA_input, apk_phis, phrases, mu, lam, theta, save=True):
@@ -426,17 +416,19 @@ def topic_labeling(OLDA_input, apk_phis, phrases, mu, lam, theta, save=True):
         labels = phrases[apk].keys()
         #print(len(labels))
         # label_ids = map(dictionary.token2id.get, labels)
-        label_ids = get_candidate_label_ids(dictionary, labels, rawinput)
+        # every slice is turned into word ids once, the scorers below all read from it
+        stats = slice_stats(dictionary, rawinput, rates)
+        label_ids = get_candidate_label_ids(dictionary, labels, stats)
         #print(len(label_ids))
-        count = count_occurence(dictionary, rawinput, label_ids)
-        total_count = total_count_(dictionary, rawinput)
-        sensi_label = get_sensitivities(dictionary, rawinput, rates, label_ids)
+        count = count_occurence(stats, label_ids)
+        total_count = total_count_(stats)
+        sensi_label = get_sensitivities(stats, label_ids)
         #print(len(sensi_label))
         rawinput_sent = list(itertools.chain.from_iterable(list(itertools.chain.from_iterable(rawinput))))
         #print(len(rawinput_sent))
-        sent_ids, sent_rates = get_candidate_sentences_ids(rawinput, rates)
+        sent_ids, sent_rates = get_candidate_sentences_ids(stats)
         #print(len(sent_ids))
-        sensi_sent = get_sensitivities_sent(rawinput_sent, sent_rates, sent_ids)
+        sensi_sent = get_sensitivities_sent(stats, sent_rates, sent_ids)
         #print(len(sensi_sent))
         jsds = []
         label_phrases = []; label_sents = []; emerge_phrases = []; emerge_sents = []
@@ -455,7 +447,7 @@ def topic_labeling(OLDA_input, apk_phis, phrases, mu, lam, theta, save=True):
             # label topic
             logging.info("labeling topic at %s slice of %s" % (t_i, apk))
             topic_label_scores = topic_labeling_(count[t_i], total_count[t_i], label_ids[t_i], sensi_label[t_i], phi, mu, lam)
-            topic_label_sent_score = topic_label_sent(dictionary, phi, rawinput_sent, sent_ids[t_i], sensi_sent[t_i], mu, lam)
+            topic_label_sent_score = topic_label_sent(stats[t_i], phi, sent_ids[t_i], sensi_sent[t_i], mu, lam)
 
             # write to file: topic phrase
             if save:
@@ -494,7 +486,7 @@ def topic_labeling(OLDA_input, apk_phis, phrases, mu, lam, theta, save=True):
                     fout_topic_width.write("%f\t" % theta)
                 fout_topic_width.write("\n")
                 continue   # skip the first epoch
-            emerging_label_scores, emerging_sent_scores = topic_detect(rawinput_sent, dictionary, phi, phis[t_i-1], count[t_i], count[t_i-1], total_count[t_i],
+            emerging_label_scores, emerging_sent_scores = topic_detect(stats[t_i], phi, phis[t_i-1], count[t_i], count[t_i-1], total_count[t_i],
                                                  total_count[t_i-1], label_ids[t_i], sent_ids[t_i], sensi_label[t_i], sensi_sent[t_i], jsds, theta, mu, lam)
             # write to file
             if save:
@@ -569,37 +561,19 @@ def rank_topic_label(count, total_count, phi, label_ids, mu=0.2):
     # construct topic matrix
     mu_div = mu / (len(phi) - 1)
     c_phi = phi * (1 + mu_div) - np.sum(phi, 0) * mu_div
-    # construct label count matrix
-    c_label_m = np.empty((len(label_ids), len(phi[0])), dtype=float)
-    for ind, label_id in enumerate(label_ids):
-        for w_id in range(len(phi[0])):
-            c_label_m[ind, w_id] = count.get((label_id, w_id)) * total_count / float((count.get(w_id) + 1) * (count.get(label_id) + 1)) if (label_id, w_id) in count else 1.0
-    c_label_m = np.log(c_label_m)
+    # construct label count matrix, sparse: log 1 = 0 for the (label, word) pairs that never co-occur
+    c_label_m = count.pmi(total_count, label_ids)
     # compute score matrix
-    topic_label_scores = np.dot(c_phi, np.transpose(c_label_m))
+    topic_label_scores = c_label_m.dot(np.transpose(c_phi)).T
     return topic_label_scores
 
-def topic_detect(rawinput_sents, dic, phi, last_phi, count, last_count, total_count, last_total_count, label_ids, sent_ids, sensi_label, sensi_sent, jsds, theta, mu, lam):
+def topic_detect(stats, phi, last_phi, count, last_count, total_count, last_total_count, label_ids, sent_ids, sensi_label, sensi_sent, jsds, theta, mu, lam):
     # matrix implementation for speed-up
     # construct count label matrix
-    c_label_m = np.empty((len(label_ids), len(phi[0])), dtype=float)
-    c_last_label_m = np.empty((len(label_ids), len(phi[0])), dtype=float)
-    for ind, label_id in enumerate(label_ids):
-        for w_id in range(len(phi[0])):
-            c_label_m[ind, w_id] = count.get((label_id, w_id)) * total_count / float((count.get(w_id) + 1) * (count.get(w_id) + 1)) if (label_id, w_id) in count else 1.0
-            c_last_label_m[ind, w_id] = last_count.get((label_id, w_id)) * last_total_count / float((last_count.get(w_id) + 1) * (last_count.get(label_id) + 1)) if (label_id, w_id) in last_count else 1.0
-
-    c_label_m = np.log(c_label_m)
-    c_last_label_m = np.log(c_last_label_m)
-    # construct sentence count matrix
-    sent_count = np.empty((len(sent_ids), len(phi[0])), dtype=float)
-    for ind, s_id in enumerate(sent_ids):
-        bow = dic.doc2bow(rawinput_sents[s_id])
-        len_s = len(rawinput_sents[s_id])
-        for w_id in range(len(phi[0])):
-            sent_count[ind, w_id] = 0.00001
-        for k, v in bow:
-            sent_count[ind, k] = v / float(len_s)
+    c_label_m = count.pmi(total_count, label_ids, by_label=False)
+    c_last_label_m = last_count.pmi(last_total_count, label_ids)
+    # construct sentence count matrix, sparse: the words missing from a sentence count 0.00001
+    sent_count = stats.sentence_freqs(sent_ids)
     # # construct residuals
     # phi_logphi = np.log(phi) * phi
     # phi_logphi_last = np.log(last_phi) * last_phi
@@ -628,10 +602,11 @@ def topic_detect(rawinput_sents, dic, phi, last_phi, count, last_count, total_co
     # TOPIC DETECT: construct phi - last_phi
     phi_m = (1 + mu/E) * phi_e - theta * last_phi[emerging_index] - mu/E * np.sum(phi_e, 0)
     # TOPIC DETECT: construct residuals
-    residuals_m = (1 + mu/E) * np.log(phi_e) * phi_e - theta * np.log(phi_last_e) * phi_last_e - mu/E * np.sum(np.log(phi_e) * phi_e, 0)
+    # xlogy: 0 log 0 = 0 for the words the padded phis of earlier slices never saw
+    residuals_m = (1 + mu/E) * xlogy(phi_e, phi_e) - theta * xlogy(phi_last_e, phi_last_e) - mu/E * np.sum(xlogy(phi_e, phi_e), 0)
     # TOPIC DETECT: compute labels
-    emerging_label_scores = np.dot((1 + mu/E) * phi_e - mu/E * np.sum(phi_e, 0), np.transpose(c_label_m)) - theta * np.dot(last_phi[emerging_index], np.transpose(c_last_label_m)) + lam * sensi_label
-    emerging_sent_scores = np.dot(phi_m, np.transpose(np.log(sent_count))) - np.sum(residuals_m, 1, keepdims=True) + lam * sensi_sent
+    emerging_label_scores = c_label_m.dot(np.transpose((1 + mu/E) * phi_e - mu/E * np.sum(phi_e, 0))).T - theta * c_last_label_m.dot(np.transpose(last_phi[emerging_index])).T + lam * sensi_label
+    emerging_sent_scores = floored_log_dot(phi_m, sent_count, 0.00001) - np.sum(residuals_m, 1, keepdims=True) + lam * sensi_sent
 
     emerging_label_scores_rst[emerging_index] = emerging_label_scores
     emerging_sent_scores_rst[emerging_index] = emerging_sent_scores
@@ -639,25 +614,18 @@ def topic_detect(rawinput_sents, dic, phi, last_phi, count, last_count, total_co
     return emerging_label_scores_rst, emerging_sent_scores_rst
 
 # rank sentence representation for topic
-def topic_label_sent(dic, phi, rawinput_sents, sent_ids, sensi, mu, lam):
+def topic_label_sent(stats, phi, sent_ids, sensi, mu, lam):
     # construct topic matrix
     mu_div = mu / (len(phi) - 1)
     c_phi = phi * (1 + mu_div) - np.sum(phi, 0) * mu_div
     # construct residual
-    phi_logphi = phi * np.log(phi)
+    phi_logphi = xlogy(phi, phi)     # 0 log 0 = 0 for the words the padded phis of earlier slices never saw
     residual_1 = mu_div * np.sum(phi_logphi)        # residual_1 is a value
     residual_2 = (1 + mu_div) * np.sum(phi_logphi, 1, keepdims=True)    # residual_2 is a n_topic*1
-    # construct sentence count matrix
-    sent_count = np.empty((len(sent_ids), len(phi[0])), dtype=float)
-    for ind, s_id in enumerate(sent_ids):
-        bow = dic.doc2bow(rawinput_sents[s_id])
-        len_s = len(rawinput_sents[s_id])
-        for w_id in range(len(phi[0])):
-            sent_count[ind, w_id] = 0.00001
-        for k, v in bow:
-            sent_count[ind, k] = v / float(len_s)
-
-    phi_sent = np.dot(c_phi, np.transpose(np.log(sent_count))) + residual_1 - residual_2 + lam * sensi
+    # construct sentence count matrix, sparse: the words missing from a sentence count 0.00001
+    sent_count = stats.sentence_freqs(sent_ids)
+
+    phi_sent = floored_log_dot(c_phi, sent_count, 0.00001) + residual_1 - residual_2 + lam * sensi
     return phi_sent
 
 def count_width(dictionary, label_phrases_ver, counts, sensi_labels, label_ids):
@@ -666,7 +634,7 @@ def count_width(dictionary, label_phrases_ver, counts, sensi_labels, label_ids):
         t_count = 0
         for phrase in phrases:
             pid = dictionary.token2id.get(phrase)
-            t_count += np.log(counts.get(pid)+1) * sensi_labels[label_ids.index(pid)]
+            t_count += np.log(counts.word_counts[pid]+1) * sensi_labels[label_ids.index(pid)]
         count_width_rst.append(t_count)
     return np.array(count_width_rst)
 
@@ -831,7 +799,7 @@ def save_phrase(review_path, bigram_num, trigram):
         extract_phrases(app)
 
 if __name__ == '__main__':
-    extract_phrases(app_files, bigram_min, trigram_min)
+    extract_phrases(app_files, bigram_min, trigram_min, token_cache, n_workers)
     load_phrase()
 
     timed_reviews = extract_review()
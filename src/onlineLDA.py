@@ -2,22 +2,147 @@
 """Online Latent Dirichlet allocation using collapsed Gibbs sampling"""
 
 from __future__ import absolute_import, division, unicode_literals  # noqa
+import glob
+import hashlib
+import json
 import logging
+import os
+import shutil
 import sys
 from sklearn.svm import SVC
 from sklearn.model_selection import StratifiedShuffleSplit
 import numpy as np
 import numbers
+from multiprocessing.pool import ThreadPool
+from scipy import sparse
+from scipy.optimize import linear_sum_assignment
 
 import _lda
 
 logger = logging.getLogger('lda')
 
+SAMPLERS = ('dense', 'sparse', 'alias')
+
+# format version of the directories written by OLDA.save_checkpoint
+CHECKPOINT_VERSION = 2
+
 PY2 = sys.version_info[0] == 2
 if PY2:
     range = xrange
 
 
+class _PhiWindow(object):
+    """Ring buffer of the topic-word matrices of the last `maxlen` slices
+
+    The matrices are kept in one contiguous (maxlen, n_topics, n_features)
+    array so that the whole window can be handled by single array
+    operations; `stack()` returns its filled part without copying.
+    Indexing and iteration follow the order of arrival, -1 being the
+    newest matrix. Appending a matrix with more features (a grown
+    vocabulary) widens the stored ones with zeros.
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self._buf = None
+        self._head = 0      # slot the next matrix goes to
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        if not -self._len <= i < self._len:
+            raise IndexError("window index out of range")
+        return self._buf[(self._head - self._len + i % self._len) % self.maxlen]
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self[i]
+
+    def append(self, phi):
+        if self._buf is not None and self._buf.shape[1] == phi.shape[0] and self._buf.shape[2] < phi.shape[1]:
+            buf = np.zeros((self.maxlen,) + phi.shape)
+            buf[:, :, :self._buf.shape[2]] = self._buf
+            self._buf = buf
+        elif self._buf is None or self._buf.shape[1:] != phi.shape:
+            self._buf = np.empty((self.maxlen,) + phi.shape)
+            self._head = self._len = 0
+        self._buf[self._head] = phi
+        self._head = (self._head + 1) % self.maxlen
+        self._len = min(self._len + 1, self.maxlen)
+
+    def extend(self, phis):
+        for phi in phis:
+            self.append(phi)
+
+    def clear(self):
+        self._head = self._len = 0
+
+    def stack(self):
+        """The filled slots as a (len, n_topics, n_features) view and the age of every slot, 0 for the newest"""
+        ages = (self._head - 1 - np.arange(self._len)) % self.maxlen
+        return self._buf[:self._len], ages
+
+
+class _CompactPrior(object):
+    """Topic-word prior of shape (n_topics, n_features) stored as a scalar
+    floor plus a sparse non-negative residual, the `top_k` largest values of
+    every topic above the floor
+
+    The sparse and alias sampling kernels and `_lda._loglikelihood_sparse`
+    take it as is; only the dense kernel needs `toarray()`.
+    """
+
+    def __init__(self, floor, residual):
+        self.floor = floor
+        self.residual = sparse.csr_matrix(residual)
+        self.residual.eliminate_zeros()
+        self.residual.sort_indices()
+        self.shape = self.residual.shape
+
+    @classmethod
+    def flat(cls, shape, value):
+        return cls(value, sparse.csr_matrix(shape, dtype=np.float64))
+
+    @classmethod
+    def truncate(cls, eta_m, top_k):
+        """Keep the `top_k` largest values of every row of eta_m, replacing the rest by their mean
+
+        The floor is lowered to the smallest kept value if that is below the
+        mean, as the residual must not be negative.
+        """
+        n_topics, W = eta_m.shape
+        if top_k >= W:
+            floor = eta_m.min()
+            return cls(floor, sparse.csr_matrix(eta_m - floor))
+        rows = np.repeat(np.arange(n_topics), top_k)
+        cols = np.argpartition(eta_m, W - top_k, axis=1)[:, W - top_k:].ravel()
+        top = eta_m[rows, cols]
+        floor = min((eta_m.sum() - top.sum()) / (n_topics * (W - top_k)), top.min())
+        return cls(floor, sparse.csr_matrix((top - floor, (rows, cols)), shape=eta_m.shape))
+
+    def sum(self, axis):
+        """Row (axis 1) or column (axis 0) sums"""
+        return self.floor * self.shape[axis] + np.asarray(self.residual.sum(axis=axis)).ravel()
+
+    def add_to(self, out, scale=1.0):
+        """out += scale * prior, in place"""
+        out += scale * self.floor
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.residual.indptr))
+        out[rows, self.residual.indices] += scale * self.residual.data
+        return out
+
+    def toarray(self):
+        return self.add_to(np.zeros(self.shape))
+
+    def widen(self, W):
+        """The prior of W >= n_features features, the new ones at the floor"""
+        res = self.residual
+        return _CompactPrior(self.floor, sparse.csr_matrix((res.data, res.indices, res.indptr),
+                                                           shape=(self.shape[0], W)))
+
+
 class OLDA:
     """Latent Dirichlet allocation using collapsed Gibbs sampling
 
@@ -27,7 +152,7 @@ class OLDA:
         Number of topics
 
     n_iter : int, default 2000
-        Number of sampling iterations
+        Number of sampling iterations, the maximum number if `tol` is set
 
     alpha : float, default 0.1
         Dirichlet parameter for distribution over topics
@@ -38,6 +163,62 @@ class OLDA:
     random_state : int or RandomState, optional
         The generator used for the initial topics.
 
+    sampler : {'dense', 'sparse', 'alias'}, default 'dense'
+        Gibbs sampling kernel. 'dense' evaluates the full conditional over all
+        topics for every token, 'sparse' uses the SparseLDA bucket
+        decomposition and only visits the topics present in the document and
+        the word, which is much cheaper for large `n_topics`. 'alias' draws
+        from per-word alias tables and document proposals with a
+        Metropolis-Hastings correction (LightLDA) at amortised O(1) cost per
+        token, independent of `n_topics`. Its word tables are only rebuilt
+        once per iteration, so it samples from an approximation of the exact
+        conditional that gets closer with more `mh_steps`.
+
+    mh_steps : int, default 4
+        Number of Metropolis-Hastings cycles per token for the 'alias' sampler.
+
+    warm_start : bool, default False
+        Initialise the topic assignments of a slice by sampling every token
+        from the previous slice's `topic_word_` instead of round-robin, so
+        that fewer sweeps are needed to converge.
+
+    tol : float, optional
+        Stop sampling a slice once the relative change of the log likelihood
+        over the last `conv_window` evaluations (taken every `refresh`
+        iterations) drops below `tol`. Sampling always runs `n_iter` iterations
+        if `tol` is None.
+
+    min_iter : int, default 0
+        Minimum number of iterations before convergence is checked.
+
+    conv_window : int, default 5
+        Number of log likelihood evaluations the relative change is taken over.
+
+    n_jobs : int, default 1
+        Number of threads sampling in parallel. With more than one thread the
+        documents are partitioned across threads, each sweeping its partition
+        against a private copy of `nzw_` and `nz_` that is merged after every
+        iteration (approximate distributed LDA, Newman et al. 2009). The
+        kernels hold no GIL while sweeping, so the threads run on as many CPUs.
+
+    temperature : float, default 1.0
+        Temperature of the tempered similarity weighting of the window of
+        past phis (`decay_flag` 2 in `fit`); higher values flatten the
+        weights towards uniform, lower values sharpen them.
+
+    align_topics : bool, default False
+        Match the topics of every past phi in the window to the topics of the
+        newest one (Hungarian algorithm on their dot products) before
+        weighting them, instead of assuming that topic k of one slice
+        continues topic k of the previous slices.
+
+    prior_top_k : int, optional
+        Keep only the `prior_top_k` largest values of every topic of the
+        aligned prior and replace the others by their mean, storing the
+        prior as that scalar floor plus a sparse residual. The 'sparse' and
+        'alias' samplers use it without ever building the dense
+        (n_topics, n_features) prior.
+
     Attributes
     ----------
     `components_` : array, shape = [n_topics, n_features]
@@ -52,6 +233,10 @@ class OLDA:
         Point estimate of the document-topic distributions (Theta in literature)
     `nz_` : array, shape = [n_topics]
         Array of topic assignment counts in final iteration.
+    `n_iter_` : int
+        Number of sampling iterations run on the last slice.
+    `loglikelihoods_train` : list of (float, int)
+        Final log likelihood and number of sampling iterations of every slice.
 
     Examples
     --------
@@ -88,7 +273,11 @@ class OLDA:
     """
 
     def __init__(self, n_topics, n_iter=2000, random_state=None,
-                 refresh=10, window_size=1, theta=0.5):
+                 refresh=10, window_size=1, theta=0.5, sampler='dense', mh_steps=4,
+                 warm_start=False, tol=None, min_iter=0, conv_window=5, n_jobs=1,
+                 temperature=1.0, align_topics=False, prior_top_k=None):
+        if sampler not in SAMPLERS:
+            raise ValueError("sampler must be one of {}, got {!r}".format(SAMPLERS, sampler))
         self.n_topics = n_topics
         self.n_iter = n_iter
         self.window_size = window_size
@@ -102,21 +291,39 @@ class OLDA:
         self.alpha_sum = None
         self.eta_sum = None
         self.theta = theta
+        self.sampler = sampler
+        self.mh_steps = mh_steps
+        self.warm_start = warm_start
+        self.tol = tol
+        self.min_iter = min_iter
+        self.conv_window = conv_window
+        self.n_jobs = n_jobs
+        self.temperature = temperature
+        self.align_topics = align_topics
+        self.prior_top_k = prior_top_k
         self.alpha = 0.1
         self.B = []
         self.A = []
+        # phis of the last `window_size` slices, the only history the prior needs
+        self._window = _PhiWindow(window_size)
+        # (n_samples, n_features, content hash) of the slices of the last `fit` and the
+        # settings they were fitted with, identifying what a checkpoint was made from
+        self._slice_keys = []
+        self._fit_params = None
+        # number of entries of B and A already written to the checkpoint
+        self._n_saved = 0
         self.loglikelihoods_pred = []
         self.loglikelihoods_train = []
         self.ll = -1
-        # random numbers that are reused
-        rng = self.check_random_state(random_state)
-        self._rands = rng.rand(1024**2 // 8)  # 1MiB of random variates
+        self._random_state = self.check_random_state(random_state)
+        # xorshift64* states of the sampling kernels, one per thread
+        self._rng_state = self._seed_kernel_rng(self._random_state, max(n_jobs, 1))
 
         # configure console logging if not already configured
         if len(logger.handlers) == 1 and isinstance(logger.handlers[0], logging.NullHandler):
             logging.basicConfig(level=logging.INFO)
 
-    def fit(self, X, decay_flag, SVM_flag, alpha=0.1, eta=0.01, y=None):
+    def fit(self, X, decay_flag, SVM_flag, alpha=0.1, eta=0.01, y=None, checkpoint_dir=None):
         """Fit the model with X.
 
         Parameters
@@ -124,6 +331,10 @@ class OLDA:
         X: array-like, shape (n_samples, n_features)
             Training data, where n_samples in the number of samples
             and n_features is the number of features. Sparse matrix allowed.
+        checkpoint_dir: str, optional
+            Directory the model is checkpointed to after every slice. If it
+            holds a checkpoint of the first slices of X, fitted with the same
+            settings, fitting resumes after them.
 
         Returns
         -------
@@ -133,32 +344,27 @@ class OLDA:
         # =================== online process===================
 
         # split X into time slots, feed into LDA model with alpha, beta matrix and B
+        self._fit_params = self._get_fit_params(decay_flag, alpha, eta)
+        start = self._resume(checkpoint_dir, X) if checkpoint_dir is not None else 0
+        if start == 0:
+            self._window.clear()
+            self._slice_keys = []
         for t, x in enumerate(X):
             # if t == len(X) - 1:     # skip the last batch
             #     return self
-            D, W = x.shape
-
-            n_topics = self.n_topics
-            if t == 0:
-                eta_m = np.full((n_topics, W), eta).astype(np.float64)
-            else:
-                eta_m = self.soft_align(self.B, self.window_size, self.theta, decay_flag).astype(np.float64)
-            alpha_m = np.full((D, n_topics), alpha).astype(np.float64)
-            self.alpha_m = alpha_m
-            self.eta_m = eta_m
-            self.eta_l = eta_m
-            self.alpha_sum = np.sum(alpha_m, 1)
-            self.eta_sum = np.sum(eta_m, 1)
-            self.alpha = alpha
-            # fit the model
-            self._fit(x, alpha_m, eta_m)
+            if t < start:
+                continue
+            self._fit_slice(x, decay_flag, alpha, eta)
+            self._slice_keys.append(self._slice_key(x))
             # test the model
             # if t != len(X) - 1:
             #     ll_pred = self.estimate_ll(X[t+1])
             #     self.loglikelihoods_pred.append(ll_pred)
-            self.loglikelihoods_train.append(self.ll)
-            self.B.append(self.topic_word_)
+            # archived phis are only read, single precision halves their memory
+            self.B.append(self.topic_word_.astype(np.float32))
             self.A.append(self.doc_topic_)
+            if checkpoint_dir is not None:
+                self.save_checkpoint(checkpoint_dir)
             #totally 12 slices
             #print(self.B[0].shape)#(8, 10000) 8 is the topic number 1*10000
             #print(self.A[0])#(4565, 8) 4565 is the sentence number
@@ -171,77 +377,348 @@ class OLDA:
         #self.test_SVM(self.A[2],"../dataset/software_label.txt")    #test for solfware     !!!!!!!!!!!!!!
         return self
 
+    def partial_fit(self, X, decay_flag=0, alpha=0.1, eta=0.01):
+        """Fit the model to one more time slice X.
+
+        The prior of the slice is aligned from the phis of the last
+        `window_size` slices seen by `fit` or `partial_fit`; older phis are
+        discarded, unlike `fit` this does not add to `B` and `A`.
+
+        Parameters
+        ----------
+        X: array-like, shape (n_samples, n_features)
+            Training data of the slice, where n_samples in the number of
+            samples and n_features is the number of features. Sparse matrix
+            allowed.
+
+        Returns
+        -------
+        topic_word : array, shape (n_topics, n_features)
+            Point estimate of the topic-word distributions of the slice
+        """
+        if isinstance(X, np.ndarray):
+            X = np.atleast_2d(X)
+        self._fit_slice(X, decay_flag, alpha, eta)
+        return self.topic_word_
+
+    def _fit_slice(self, x, decay_flag, alpha, eta):
+        """Fit one time slice x with the prior aligned from the window of past phis"""
+        D, W = x.shape
+        n_topics = self.n_topics
+        if not self._window:
+            if self.prior_top_k:
+                eta_m = _CompactPrior.flat((n_topics, W), eta)
+            else:
+                eta_m = np.full((n_topics, W), eta).astype(np.float64)
+        else:
+            eta_m = self.soft_align(self._window, self.window_size, self.theta, decay_flag).astype(np.float64)
+            if self.prior_top_k:
+                eta_m = _CompactPrior.truncate(eta_m, self.prior_top_k)
+            eta_m = self._widen_prior(eta_m, W, eta)
+        alpha_m = np.full((D, n_topics), alpha).astype(np.float64)
+        self.alpha_m = alpha_m
+        self.eta_m = eta_m
+        self.eta_l = eta_m
+        self.alpha_sum = np.sum(alpha_m, 1)
+        self.eta_sum = eta_m.sum(axis=1)
+        self.alpha = alpha
+        # fit the model
+        self._fit(x, alpha_m, eta_m)
+        self.loglikelihoods_train.append((self.ll, self.n_iter_))
+        self._window.append(self.topic_word_)
+
+    def _widen_prior(self, eta_m, W, eta):
+        """Extend the aligned prior to the W features of a slice with a grown vocabulary
+
+        Words new to the vocabulary have no past topics to align; their prior
+        is the flat `eta` of the first slice, or the floor of a compact prior.
+        """
+        n_features = eta_m.shape[1]
+        if W < n_features:
+            raise ValueError("slice has {} features, fewer than the {} of the previous slices; "
+                             "the vocabulary can only grow".format(W, n_features))
+        if W == n_features:
+            return eta_m
+        logger.info("vocabulary grew from {} to {} words".format(n_features, W))
+        if isinstance(eta_m, _CompactPrior):
+            return eta_m.widen(W)
+        return np.pad(eta_m, ((0, 0), (0, W - n_features)), 'constant', constant_values=eta)
+
+    def save_checkpoint(self, path):
+        """Save the fitted slices and the sampler state to the directory `path`
+
+        Every array goes to its own .npy file so that `load_checkpoint` can
+        memory-map them. The per-slice `B` and `A` files never change once
+        written. The rest of the state goes to a new `state_<n>` directory
+        that only becomes current when `meta.json` is replaced, so an
+        interrupted save leaves the previous checkpoint intact.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name, mats in (('B', self.B), ('A', self.A)):
+            for t in range(self._n_saved, len(mats)):
+                np.save(os.path.join(path, '%s_%04d.npy' % (name, t)), mats[t])
+        self._n_saved = min(len(self.B), len(self.A))
+
+        old_states = glob.glob(os.path.join(path, 'state_*'))
+        state = 'state_%04d' % (max([int(d.rsplit('_', 1)[1]) for d in old_states] or [-1]) + 1)
+        os.makedirs(os.path.join(path, state))
+        rs_name, rs_key, rs_pos, rs_has_gauss, rs_gauss = self._random_state.get_state()
+        arrays = [('nzw', self.nzw_), ('ndz', self.ndz_), ('nz', self.nz_),
+                  ('rng_state', self._rng_state), ('random_state', rs_key)]
+        compact = isinstance(self.eta_l, _CompactPrior)
+        if compact:
+            res = self.eta_l.residual
+            arrays += [('eta_l_floor', np.array([self.eta_l.floor])), ('eta_l_data', res.data),
+                       ('eta_l_indices', res.indices), ('eta_l_indptr', res.indptr)]
+        else:
+            arrays += [('eta_l', self.eta_l)]
+        arrays += [('window%d' % i, phi) for i, phi in enumerate(self._window)]
+        for name, arr in arrays:
+            np.save(os.path.join(path, state, name + '.npy'), arr)
+        meta = {
+            'version': CHECKPOINT_VERSION,
+            'state': state,
+            'n_topics': self.n_topics,
+            'window_size': self.window_size,
+            'n_B': len(self.B),
+            'n_A': len(self.A),
+            'n_window': len(self._window),
+            'eta_l_shape': list(self.eta_l.shape) if compact else None,
+            'slice_keys': self._slice_keys,
+            'fit_params': self._fit_params,
+            'loglikelihoods_train': self.loglikelihoods_train,
+            'll': self.ll,
+            'alpha': self.alpha,
+            'random_state': [rs_name, int(rs_pos), int(rs_has_gauss), float(rs_gauss)],
+        }
+        meta_file = os.path.join(path, 'meta.json')
+        with open(meta_file + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.rename(meta_file + '.tmp', meta_file)
+        for old_state in old_states:
+            shutil.rmtree(old_state)
+
+    def load_checkpoint(self, path, mmap_mode='r'):
+        """Restore the state saved by `save_checkpoint` to the directory `path`
+
+        `B`, `A` and the counts of the last slice are memory-mapped with
+        `mmap_mode`; the window of phis the next prior is aligned from is
+        read into memory.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != CHECKPOINT_VERSION:
+            raise ValueError("unsupported checkpoint version {}, expected {}".format(
+                meta['version'], CHECKPOINT_VERSION))
+        if meta['n_topics'] != self.n_topics:
+            raise ValueError("checkpoint has {} topics, the model {}".format(meta['n_topics'], self.n_topics))
+
+        def load(name, mmap_mode=mmap_mode):
+            return np.load(os.path.join(path, meta['state'], name + '.npy'), mmap_mode=mmap_mode)
+
+        self.B = [np.load(os.path.join(path, 'B_%04d.npy' % t), mmap_mode=mmap_mode) for t in range(meta['n_B'])]
+        self.A = [np.load(os.path.join(path, 'A_%04d.npy' % t), mmap_mode=mmap_mode) for t in range(meta['n_A'])]
+        self._n_saved = min(len(self.B), len(self.A))
+        self.nzw_, self.ndz_, self.nz_ = load('nzw'), load('ndz'), load('nz')
+        if meta['eta_l_shape'] is not None:
+            res = sparse.csr_matrix((load('eta_l_data', None), load('eta_l_indices', None), load('eta_l_indptr', None)),
+                                    shape=tuple(meta['eta_l_shape']))
+            self.eta_l = _CompactPrior(load('eta_l_floor', None)[0], res)
+        else:
+            self.eta_l = load('eta_l', None)
+        self._window.clear()
+        self._window.extend(load('window%d' % i, None) for i in range(meta['n_window']))
+        if self._window:
+            self.components_ = self.topic_word_ = self._window[-1].copy()
+        if self.A:
+            self.doc_topic_ = self.A[-1]
+        self._slice_keys = [tuple(key) for key in meta['slice_keys']]
+        self._fit_params = meta['fit_params']
+        self.loglikelihoods_train = [tuple(ll) for ll in meta['loglikelihoods_train']]
+        self.ll = meta['ll']
+        self.alpha = meta['alpha']
+
+        rs_name, rs_pos, rs_has_gauss, rs_gauss = meta['random_state']
+        if self._random_state is np.random.mtrand._rand:
+            # restore into a generator of our own rather than reseed the caller's global one
+            self._random_state = np.random.RandomState()
+        self._random_state.set_state((str(rs_name), load('random_state', None), rs_pos, rs_has_gauss, rs_gauss))
+        rng_state = load('rng_state', None)
+        if len(rng_state) == len(self._rng_state):
+            self._rng_state = rng_state
+        else:
+            # the number of threads changed, derive new streams from the restored generator
+            self._rng_state = self._seed_kernel_rng(self._random_state, len(self._rng_state))
+        return self
+
+    def _resume(self, checkpoint_dir, X):
+        """Load the checkpoint in `checkpoint_dir` if it was made from the first slices of X with the settings of this fit
+
+        Returns the number of slices of X the checkpoint covers, 0 if there
+        is none to resume from.
+        """
+        meta_file = os.path.join(checkpoint_dir, 'meta.json')
+        if not os.path.exists(meta_file):
+            return 0
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta['version'] != CHECKPOINT_VERSION:
+            logger.warning("checkpoint in {} has version {}, expected {}, fitting from scratch".format(
+                checkpoint_dir, meta['version'], CHECKPOINT_VERSION))
+            return 0
+        if meta['fit_params'] != self._fit_params:
+            changed = sorted(name for name in self._fit_params
+                             if (meta['fit_params'] or {}).get(name) != self._fit_params[name])
+            logger.warning("checkpoint in {} was fitted with other settings ({}), fitting from scratch".format(
+                checkpoint_dir, ", ".join(changed)))
+            return 0
+        slice_keys = [tuple(key) for key in meta['slice_keys']]
+        n_done = len(slice_keys)
+        if n_done > len(X) or [self._slice_key(x) for x in X[:n_done]] != slice_keys:
+            logger.warning("checkpoint in {} does not match the data, fitting from scratch".format(checkpoint_dir))
+            return 0
+        self.load_checkpoint(checkpoint_dir)
+        logger.info("resuming from the checkpoint in {} after {} slices".format(checkpoint_dir, n_done))
+        return n_done
+
+    def _slice_key(self, x):
+        """(n_samples, n_features, SHA-1 of the counts) of a slice, to tell slices apart"""
+        D, W = x.shape
+        # canonical CSR, so that the same counts always hash the same
+        x = sparse.csr_matrix(x, dtype=np.int64, copy=True)
+        x.sum_duplicates()
+        h = hashlib.sha1()
+        for arr in (x.indptr, x.indices, x.data):
+            h.update(np.ascontiguousarray(arr, dtype=np.int64).tobytes())
+        return (int(D), int(W), h.hexdigest())
+
+    def _get_fit_params(self, decay_flag, alpha, eta):
+        """The settings of `fit` the fitted slices depend on, as read back from meta.json"""
+        params = {
+            'n_topics': self.n_topics,
+            'n_iter': self.n_iter,
+            'window_size': self.window_size,
+            'theta': self.theta,
+            'sampler': self.sampler,
+            'mh_steps': self.mh_steps,
+            'warm_start': self.warm_start,
+            'tol': self.tol,
+            'min_iter': self.min_iter,
+            'conv_window': self.conv_window,
+            'refresh': self.refresh,
+            'temperature': self.temperature,
+            'align_topics': self.align_topics,
+            'prior_top_k': self.prior_top_k,
+            'decay_flag': decay_flag,
+            'alpha': alpha,
+            'eta': eta,
+        }
+        # numpy scalars as plain numbers, strings as unicode, as json.load returns them
+        return json.loads(json.dumps(params, default=lambda value: value.item()))
+
     def soft_align(self, B, window_size, theta, decay_flag):
         """
         Soft alignment to produce a soft weight sum of B according to window size
+
+        B is the `_PhiWindow` of past phis or a list of them, the newest last.
         """
-        eta = B[-1]
-        eta_new = np.zeros(eta.shape)
+        if isinstance(B, _PhiWindow):
+            phis, ages = B.stack()
+        else:
+            B = B[-window_size:]
+            # zero-pad the phis of slices with a smaller vocabulary
+            W = max(phi.shape[1] for phi in B)
+            phis = np.zeros((len(B),) + (B[0].shape[0], W))
+            for s, phi in enumerate(B):
+                phis[s, :, :phi.shape[1]] = phi
+            ages = np.arange(len(phis))[::-1]
+        newest = ages.argmin()
+        eta = phis[newest]
+        if self.align_topics:
+            prods, topics = self._match_topics(eta, phis, newest)
+        else:
+            # similarity of every past topic to the same topic of the newest slice, shape (window, n_topics)
+            prods = np.einsum('ij,sij->si', eta, phis, optimize=True)
         if decay_flag == 0:
             logging.info("Using similarities.")
-            weights = self.softmax(eta, B, window_size)
+            weights = self.softmax(prods)
+        elif decay_flag == 2:
+            logging.info("Using similarities with temperature %s." % self.temperature)
+            weights = self.softmax(prods, self.temperature)
         else:
             logging.info("Using exponential decay.")
-            weights = self.Exponential_Decay(eta, B, window_size)
-        for i in range(window_size):
-            if i > len(B)-1:
-                break
-            B_i = B[-i-1] * weights[i][:, np.newaxis]
-            eta_new += B_i
-        eta_new = theta * self.eta_l + (1 - theta) * eta_new
+            weights = self.Exponential_Decay(prods, ages, window_size)
+        if self.align_topics:
+            # scatter the weights to the matched topics, (n_topics, window, n_topics), and
+            # sum the whole window in one (n_topics, window * n_topics) x (window * n_topics, W) product
+            n_slots, n_topics, W = phis.shape
+            slot_weights = np.zeros((n_topics, n_slots, n_topics))
+            slot_weights[np.arange(n_topics), np.arange(n_slots)[:, np.newaxis], topics] = weights
+            eta_new = np.dot(slot_weights.reshape(n_topics, -1), phis.reshape(-1, W))
+        else:
+            eta_new = np.einsum('si,sij->ij', weights, phis, optimize=True)
+        eta_new *= 1 - theta
+        if isinstance(self.eta_l, _CompactPrior):
+            self.eta_l.add_to(eta_new, theta)
+        else:
+            eta_new += theta * self.eta_l
         return eta_new
 
-    def softmax(self, eta, B, window_size): #maybe here!
-        prods = []
-        for i in range(window_size):
-            if i > len(B)-1:
-                break
-            prods.append(np.einsum('ij,ij->i', eta, B[-i-1]))   #eta*B, every element times each
-            #print(np.einsum('ij,ij->i', eta, B[-i-1]))
-            #print(B[-i-1].shape)#(8, 10000)
-            #print(eta.shape)#(8, 10000)
-        weights = np.exp(np.array(prods))
-        #print(len(weights)) #window_size
-        #print(weights[0].shape) #8
-        #print(weights[0])   #[ 1.00263107  1.00360126  1.00329721  1.00297992  1.01121932  1.00732886  1.00261926  1.01368105]
+    def _match_topics(self, eta, phis, newest):
+        """Match the topics of every phi in the window to the topics of eta
+
+        Returns the similarities of the matched topics and the matching, both
+        of shape (window, n_topics): topic `topics[s, k]` of phi `s` is
+        matched to topic k of eta, `prods[s, k]` is their dot product. The
+        matching maximises the summed dot products of every phi; the newest
+        phi, `phis[newest]`, is eta itself and keeps its topics.
+        """
+        n_slots, n_topics = phis.shape[:2]
+        # all topic-to-topic similarities of every slice in one batched product, (window, n_topics, n_topics)
+        sims = np.matmul(phis, eta.T)
+        topics = np.tile(np.arange(n_topics), (n_slots, 1))
+        for s in range(n_slots):
+            if s == newest:
+                continue
+            old_topics, new_topics = linear_sum_assignment(-sims[s])
+            topics[s, new_topics] = old_topics
+            logger.debug("slot {}: {} topics matched to a different index".format(
+                s, np.count_nonzero(topics[s] != np.arange(n_topics))))
+        prods = sims[np.arange(n_slots)[:, np.newaxis], topics, np.arange(n_topics)]
+        return prods, topics
+
+    def softmax(self, prods, temperature=1.0): #maybe here!
+        """Column normalised exp of the (window, n_topics) similarities divided by `temperature`"""
         # weights = np.ones(weights.shape)            # compare to uniform
-        n_weights = weights / np.sum(weights, 0)  # column normalize
+        n_weights = self._normalize_log_weights(prods / temperature)
         #print(n_weights)
-        
+
         #[[ 0.33381404  0.33574404  0.33377568  0.3337511   0.33380458  0.33383676   0.33399144  0.33362642]
         # [ 0.33305652  0.33212032  0.33305132  0.33308513  0.33307685  0.33294443   0.33296081  0.33313675]
         # [ 0.33312945  0.33213563  0.333173    0.33316377  0.33311857  0.33321881   0.33304775  0.33323683]]
         return n_weights
 
-    def Exponential_Decay(self, eta, B, window_size):
+    def Exponential_Decay(self, prods, ages, window_size):
+        """Column normalised exp of the similarities, damped by exp(-decay_k*(window_size-age-1))"""
         decay_k = 1.0
-        decay_mu = []
-        prods = []
-        for i in range(window_size):
-            if i > len(B)-1:
-                break
-            decay_mu.append(np.exp(-decay_k*(window_size-i-1)))
-            prods.append(np.einsum('ij,ij->i', eta, B[-i-1]))   #eta*B, every element times each
-            #print(B[-i-1].shape)#(8, 10000)
-            #print(eta.shape)#(8, 10000)
-        weights = np.exp(np.array(prods))
-        for i, mu in enumerate(decay_mu):
-            weights[i] = mu * weights[i]
-            #print(weights[i])
-            #print(mu)
-            #print(temp)
-        #print(len(weights)) #window_size
-        #print(weights[0].shape) #8
-        #print(weights[0])   #[ 1.00263107  1.00360126  1.00329721  1.00297992  1.01121932  1.00732886  1.00261926  1.01368105]
+        # log of the damped weights exp(prods) * decay_mu
+        log_weights = prods - (decay_k * (window_size - ages - 1))[:, np.newaxis]
         # weights = np.ones(weights.shape)            # compare to uniform
-        n_weights = weights / np.sum(weights, 0)  # column normalize
+        n_weights = self._normalize_log_weights(log_weights)
         #print(n_weights)
-        
+
         #[[ 0.18653837  0.1865785   0.18666854  0.18725954  0.18683939  0.18660835   0.18821754  0.18675937]
         #[ 0.30712336  0.30695458  0.30711745  0.30811781  0.30709808  0.30705398   0.30602268  0.30722897]
         #[ 0.50633827  0.50646693  0.506214    0.50462266  0.50606253  0.50633766   0.50575978  0.50601165]]
         return n_weights
 
+    def _normalize_log_weights(self, log_weights):
+        """exp(log_weights) normalised over axis 0, shifted by the column maxima (log-sum-exp) so that exp cannot overflow"""
+        weights = np.exp(log_weights - log_weights.max(axis=0))
+        weights /= weights.sum(axis=0)
+        return weights
+
     def estimate_ll(self, X):
         doc_topic = self.transform(X)
         ll_pred = self.compute_loglikelihood(doc_topic, self.topic_word_, X)
@@ -276,7 +753,7 @@ class OLDA:
         self._fit(X)
         return self.doc_topic_
 
-    def transform(self, X, max_iter=20, tol=1e-16):
+    def transform(self, X, max_iter=20, tol=1e-16, batch_size=1000, n_jobs=None):
         """Transform the data X according to previously fitted model
 
         Parameters
@@ -288,11 +765,17 @@ class OLDA:
             Maximum number of iterations in iterated-pseudocount estimation.
         tol: double, optional
             Tolerance value used in stopping condition.
+        batch_size : int, optional
+            Number of documents whose pseudo-counts are updated together.
+        n_jobs : int, optional
+            Number of threads the batches are spread over, `self.n_jobs` if
+            None.
 
         Returns
         -------
         doc_topic : array-like, shape (n_samples, n_topics)
-            Point estimate of the document-topic distributions
+            Point estimate of the document-topic distributions. Documents
+            without any words get the uniform distribution.
 
         Note
         ----
@@ -304,11 +787,80 @@ class OLDA:
             # in case user passes a (non-sparse) array of shape (n_features,)
             # turn it into an array of shape (1, n_features)
             X = np.atleast_2d(X)
-        doc_topic = np.empty((X.shape[0], self.n_topics))
+        D = X.shape[0]
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        doc_topic = np.full((D, self.n_topics), 1.0 / self.n_topics)
         WS, DS = self.matrix_to_lists(X)
-        # TODO: this loop is parallelizable
-        for d in np.unique(DS):
-            doc_topic[d] = self._transform_single(WS[DS == d], max_iter, tol)
+        # tokens are grouped by document, so every document is one run of WS
+        docs = np.unique(DS)
+        doc_len = np.bincount(DS, minlength=D)[docs]
+        offsets = np.concatenate(([0], np.cumsum(doc_len)))
+
+        def transform_batch(start):
+            end = min(start + batch_size, len(docs))
+            doc_topic[docs[start:end]] = self._transform_batch(
+                WS[offsets[start]:offsets[end]], doc_len[start:end], max_iter, tol)
+
+        starts = range(0, len(docs), batch_size)
+        if n_jobs > 1 and len(starts) > 1:
+            pool = ThreadPool(n_jobs)
+            pool.map(transform_batch, starts)
+            pool.close()
+            pool.join()
+        else:
+            for start in starts:
+                transform_batch(start)
+        return doc_topic
+
+    def _transform_batch(self, WS, doc_len, max_iter, tol):
+        """Transform a batch of documents according to the previously fit model
+
+        Runs the updates of `_transform_single` on the tokens of all
+        documents at once. A document whose update changes by less than `tol`
+        is finished and its tokens are dropped from the following iterations.
+
+        Parameters
+        ----------
+        WS : 1D numpy array of integers
+            Words of the batch, the documents one after another
+        doc_len : 1D numpy array of integers
+            Number of words of every document, all positive
+        max_iter : int
+            Maximum number of iterations in iterated-pseudocount estimation.
+        tol: double
+            Tolerance value used in stopping condition.
+
+        Returns
+        -------
+        doc_topic : array, shape (len(doc_len), n_topics)
+            Point estimate of the topic distributions of the documents
+
+        """
+        doc_topic = np.empty((len(doc_len), self.n_topics))
+        active = np.arange(len(doc_len))
+        starts = np.concatenate(([0], np.cumsum(doc_len)[:-1]))
+        PZS = np.zeros((len(WS), self.n_topics))
+        PZS_doc = np.zeros((len(doc_len), self.n_topics))
+        for iteration in range(max_iter + 1): # +1 is for initialization
+            PZS_new = self.components_[:, WS].T
+            PZS_new *= (np.repeat(PZS_doc, doc_len, axis=0) - PZS + self.alpha)
+            PZS_new /= PZS_new.sum(axis=1)[:, np.newaxis] # vector to single column matrix
+            delta_naive = np.add.reduceat(np.abs(PZS_new - PZS).sum(axis=1), starts)
+            logger.debug('transform iter {}, max delta {}'.format(iteration, delta_naive.max()))
+            PZS = PZS_new
+            PZS_doc = np.add.reduceat(PZS, starts, axis=0)
+            done = delta_naive < tol
+            if iteration == max_iter:
+                done[:] = True
+            if done.any():
+                doc_topic[active[done]] = PZS_doc[done] / PZS_doc[done].sum(axis=1)[:, np.newaxis]
+                keep = ~done
+                if not keep.any():
+                    break
+                token_keep = np.repeat(keep, doc_len)
+                WS, PZS = WS[token_keep], PZS[token_keep]
+                active, doc_len, PZS_doc = active[keep], doc_len[keep], PZS_doc[keep]
+                starts = np.concatenate(([0], np.cumsum(doc_len)[:-1]))
         return doc_topic
 
     def _transform_single(self, doc, max_iter, tol):
@@ -358,24 +910,39 @@ class OLDA:
             Training vector, where n_samples in the number of samples and
             n_features is the number of features. Sparse matrix allowed.
         """
-        random_state = self.check_random_state(self.random_state)
-        rands = self._rands.copy()
         self._initialize(X)
-
-
+        self._prepare_sampler()
+        pool = ThreadPool(self.n_jobs) if self.n_jobs > 1 else None
+        # running log p(w,z), updated by the kernel as tokens move; the
+        # thread-private counts of the parallel sweep do not add up exactly,
+        # so that mode recomputes the likelihood at every refresh instead
+        self._ll_track = np.array([self.loglikelihood()]) if pool is None else None
+
+        self.n_iter_ = self.n_iter
         for it in range(self.n_iter):
-            # FIXME: using numpy.roll with a random shift might be faster
-            random_state.shuffle(rands)
             if it % self.refresh == 0:
-                ll = self.loglikelihood()
+                ll = self._current_loglikelihood()
                 logger.info("<{}> log likelihood: {:.0f}".format(it, ll))
                 # keep track of loglikelihoods for monitoring convergence
                 self.loglikelihoods_.append(ll)
-            self._sample_topics(rands)
+                if it >= self.min_iter and self._converged():
+                    logger.info("<{}> converged".format(it))
+                    self.n_iter_ = it
+                    break
+            if pool is None:
+                self._sample_topics()
+            else:
+                self._sample_topics_parallel(pool)
+        if pool is not None:
+            pool.close()
+            pool.join()
         self.ll = self.loglikelihood()
-        logger.info("<{}> log likelihood: {:.0f}".format(self.n_iter - 1, self.ll))
+        logger.info("<{}> log likelihood: {:.0f}".format(self.n_iter_ - 1, self.ll))
         # note: numpy /= is integer division
-        self.components_ = (self.nzw_ + eta).astype(float)
+        if isinstance(eta, _CompactPrior):
+            self.components_ = eta.add_to(self.nzw_.astype(float))
+        else:
+            self.components_ = (self.nzw_ + eta).astype(float)
         self.components_ /= np.sum(self.components_, axis=1)[:, np.newaxis]
         self.topic_word_ = self.components_
         self.doc_topic_ = (self.ndz_ + alpha).astype(float)
@@ -385,8 +952,19 @@ class OLDA:
         del self.WS
         del self.DS
         del self.ZS
+        self._sampler_args = None
+        self._partitions = None
+        self._ll_track = None
         return self
 
+    def _converged(self):
+        """Whether the relative log likelihood change over the last `conv_window` evaluations is below `tol`"""
+        lls = self.loglikelihoods_
+        if self.tol is None or len(lls) <= self.conv_window:
+            return False
+        ll_old = lls[-1 - self.conv_window]
+        return abs(lls[-1] - ll_old) <= self.tol * abs(ll_old)
+
     def _initialize(self, X):
         D, W = X.shape
         N = int(X.sum())
@@ -398,21 +976,79 @@ class OLDA:
         logger.info("n_topics: {}".format(n_topics))
         logger.info("n_iter: {}".format(n_iter))
 
-        self.nzw_ = nzw_ = np.zeros((n_topics, W), dtype=np.intc)
-        self.ndz_ = ndz_ = np.zeros((D, n_topics), dtype=np.intc)
-        self.nz_ = nz_ = np.zeros(n_topics, dtype=np.intc)
-
         self.WS, self.DS = WS, DS = self.matrix_to_lists(X)
-        self.ZS = ZS = np.empty_like(self.WS, dtype=np.intc)
         np.testing.assert_equal(N, len(WS))
-        for i in range(N):
-            w, d = WS[i], DS[i]
-            z_new = i % n_topics
-            ZS[i] = z_new
-            ndz_[d, z_new] += 1
-            nzw_[z_new, w] += 1
-            nz_[z_new] += 1
+        topic_word = getattr(self, 'topic_word_', None)
+        if self.warm_start and topic_word is not None and topic_word.shape[1] <= W:
+            logger.info("warm start from the previous topic-word distribution")
+            # words new to the vocabulary start from a uniform topic
+            topic_word = np.pad(topic_word, ((0, 0), (0, W - topic_word.shape[1])), 'constant', constant_values=1)
+            self.ZS = ZS = self._warm_start_topics(WS, topic_word)
+        else:
+            self.ZS = ZS = (np.arange(N) % n_topics).astype(np.intc)
+        # counts of the (topic, word) and (document, topic) pairs as flat bincounts
+        ZS_p = ZS.astype(np.intp)
+        self.nzw_ = np.bincount(ZS_p * W + WS, minlength=n_topics * W).reshape(n_topics, W).astype(np.intc)
+        self.ndz_ = np.bincount(DS.astype(np.intp) * n_topics + ZS_p,
+                                minlength=D * n_topics).reshape(D, n_topics).astype(np.intc)
+        self.nz_ = np.bincount(ZS_p, minlength=n_topics).astype(np.intc)
         self.loglikelihoods_ = []
+        self._partitions = self._partition_documents(DS, self.n_jobs)
+
+    def _warm_start_topics(self, WS, topic_word):
+        """Draw the initial topic of every token from the column of its word in `topic_word`
+
+        All (word, topic) cumulative distributions are laid out in one
+        increasing array, row w shifted by w, so that a single searchsorted
+        call inverts them for all tokens at once.
+        """
+        n_topics, W = topic_word.shape
+        cdf = np.cumsum(topic_word.T, axis=1)
+        cdf /= cdf[:, -1:]
+        cdf += np.arange(W)[:, np.newaxis]
+        u = self._random_state.rand(len(WS)) + WS
+        ZS = np.searchsorted(cdf.ravel(), u, side='right') - WS.astype(np.intp) * n_topics
+        return np.minimum(ZS, n_topics - 1).astype(np.intc)
+
+    def _partition_documents(self, DS, n_parts):
+        """Token offsets splitting DS into `n_parts` runs of whole documents
+
+        Returns an increasing array of offsets starting at 0 and ending at
+        len(DS); it may hold fewer than `n_parts` runs for tiny corpora.
+        """
+        N = len(DS)
+        cuts = np.linspace(0, N, n_parts + 1).astype(int)[1:-1]
+        # move every cut back to the first token of its document
+        cuts = np.searchsorted(DS, DS[cuts], side='left') if N else cuts
+        return np.unique(np.concatenate(([0], cuts, [N])))
+
+    def _prepare_sampler(self):
+        """Precompute the per-fit arguments of the selected sampling kernel.
+
+        The sparse and alias kernels take eta as a per-word floor plus a
+        word-major sparse residual and alpha as a per-document floor, so that
+        the smoothing and document buckets can be cached across topics and
+        the prior of a single word can be looked up without a dense row.
+        The dense kernel takes the dense eta, which has to be built for a
+        compact prior.
+        """
+        self._sampler_args = None
+        compact = isinstance(self.eta_m, _CompactPrior)
+        if self.sampler == 'dense':
+            if compact:
+                self._sampler_args = (self.eta_m.toarray(),)
+            return
+        alpha_floor = self.alpha_m.min(axis=1)
+        alpha_flat = (self.alpha_m.max(axis=1) == alpha_floor).astype(np.intc)
+        if compact:
+            eta_floor = np.full(self.eta_m.shape[1], self.eta_m.floor)
+            eta_res = self.eta_m.residual.tocsc()
+        else:
+            eta_floor = self.eta_m.min(axis=0)
+            eta_res = sparse.csc_matrix(self.eta_m - eta_floor)
+        self._sampler_args = (alpha_floor, alpha_flat, eta_floor,
+                              eta_res.indptr.astype(np.intc), eta_res.indices.astype(np.intc),
+                              eta_res.data.astype(np.float64))
 
     def loglikelihood(self):
         """Calculate complete log likelihood, log p(w,z)
@@ -425,18 +1061,74 @@ class OLDA:
         alpha_sum = self.alpha_sum
         eta_sum = self.eta_sum
         nd = np.sum(ndz, axis=1).astype(np.intc)
+        if isinstance(eta_m, _CompactPrior):
+            eta_res = eta_m.residual
+            return _lda._loglikelihood_sparse(nzw, ndz, nz, nd, alpha_m, np.full(eta_m.shape[1], eta_m.floor),
+                                              eta_res.indptr.astype(np.intc), eta_res.indices.astype(np.intc),
+                                              eta_res.data.astype(np.float64), alpha_sum, eta_sum)
         return _lda._loglikelihood(nzw, ndz, nz, nd, alpha_m, eta_m, alpha_sum, eta_sum)
 
-    def _sample_topics(self, rands):
+    def _current_loglikelihood(self):
+        """log p(w,z) of the current assignments, from the running total when one is kept"""
+        if self._ll_track is not None:
+            return self._ll_track[0]
+        return self.loglikelihood()
+
+    def _sample_topics(self):
         """Samples all topic assignments. Called once per iteration."""
-        n_topics, vocab_size = self.nzw_.shape
+        self._sample_range(self.WS, self.DS, self.ZS, self.nzw_, self.nz_, self._rng_state[:1],
+                           self._ll_track)
+        # self.sample_topics_py(self.WS, self.DS, self.ZS, self.nzw_, self.ndz_, self.nz_,
+        #                         alpha, eta, eta_sum, self._random_state.rand(len(self.WS)))
+
+    def _sample_topics_parallel(self, pool):
+        """Samples all topic assignments on `pool`, one document partition per thread.
+
+        Every thread sweeps its partition against a private copy of the
+        topic-word counts; the copies are merged afterwards. `ndz_` is shared
+        since the partitions never split a document.
+        """
+        nzw, nz = self.nzw_, self.nz_
+        bounds = self._partitions
+
+        def sweep(j):
+            start, end = bounds[j], bounds[j + 1]
+            nzw_j, nz_j = nzw.copy(), nz.copy()
+            self._sample_range(self.WS[start:end], self.DS[start:end], self.ZS[start:end],
+                               nzw_j, nz_j, self._rng_state[j:j + 1])
+            return nzw_j - nzw, nz_j - nz
+
+        deltas = pool.map(sweep, range(len(bounds) - 1))
+        for nzw_delta, nz_delta in deltas:
+            nzw += nzw_delta
+            nz += nz_delta
+
+    def _sample_range(self, WS, DS, ZS, nzw, nz, rng_state, ll_delta=None):
+        """Runs the selected sampling kernel over the tokens WS, DS, ZS.
+
+        `rng_state` is a one-element view of `_rng_state` owned by the
+        calling thread; the kernel advances it in place. If `ll_delta` is
+        given, the change in log p(w,z) caused by the sweep is added to
+        `ll_delta[0]`.
+        """
         alpha = self.alpha_m    #np.repeat(self.alpha, n_topics).astype(np.float64)
         eta = self.eta_m        #np.repeat(self.eta, vocab_size).astype(np.float64)
         eta_sum = self.eta_sum
-        _lda._sample_topics(self.WS, self.DS, self.ZS, self.nzw_, self.ndz_, self.nz_,
-                                alpha, eta, eta_sum, rands)
-        # self.sample_topics_py(self.WS, self.DS, self.ZS, self.nzw_, self.ndz_, self.nz_,
-        #                         alpha, eta, eta_sum, rands)
+        if self.sampler == 'sparse':
+            alpha_floor, alpha_flat, eta_floor, res_ptr, res_topics, res = self._sampler_args
+            _lda._sample_topics_sparse(WS, DS, ZS, nzw, self.ndz_, nz,
+                                       alpha, alpha_floor, alpha_flat, eta_floor, res_ptr, res_topics, res,
+                                       eta_sum, rng_state, ll_delta)
+        elif self.sampler == 'alias':
+            alpha_floor, alpha_flat, eta_floor, res_ptr, res_topics, res = self._sampler_args
+            _lda._sample_topics_alias(WS, DS, ZS, nzw, self.ndz_, nz,
+                                      alpha, self.alpha_sum, alpha_flat, eta_floor, res_ptr, res_topics, res,
+                                      eta_sum, rng_state, self.mh_steps, ll_delta)
+        else:
+            if self._sampler_args is not None:
+                eta, = self._sampler_args
+            _lda._sample_topics(WS, DS, ZS, nzw, self.ndz_, nz,
+                                alpha, eta, eta_sum, rng_state, ll_delta)
 
     def searchsorted_py(self, arr, length, value):
         """Bisection search (c.f. numpy.searchsorted)
@@ -492,6 +1184,11 @@ class OLDA:
             ndz[d, z_new] += 1
             nz[z_new] += 1
 
+    def _seed_kernel_rng(self, random_state, n_states):
+        """Nonzero 64-bit seeds for the generators of the sampling kernels"""
+        seeds = random_state.randint(1, np.iinfo(np.int64).max, size=n_states, dtype=np.int64)
+        return seeds.astype(np.uint64)
+
     def check_random_state(self, seed):
         if seed is None:
             # i.e., use existing RandomState
@@ -521,30 +1218,21 @@ class OLDA:
             logger.warning("all zero row in document-term matrix found")
         if np.count_nonzero(doc_word.sum(axis=0)) != doc_word.shape[1]:
             logger.warning("all zero column in document-term matrix found")
-        sparse = True
-        try:
-            # if doc_word is a scipy sparse matrix
-            doc_word = doc_word.copy().tolil()
-        except AttributeError:
-            sparse = False
-
-        if sparse and not np.issubdtype(doc_word.dtype, int):
-            raise ValueError("expected sparse matrix with integer values, found float values")
-
-        ii, jj = np.nonzero(doc_word)
-        if sparse:
-            ss = tuple(doc_word[i, j] for i, j in zip(ii, jj))
+        if sparse.issparse(doc_word):
+            if not np.issubdtype(doc_word.dtype, np.integer):
+                raise ValueError("expected sparse matrix with integer values, found float values")
+            # canonical CSR: duplicates summed, columns sorted within rows, no explicit zeros
+            doc_word = sparse.csr_matrix(doc_word, copy=True)
+            doc_word.sum_duplicates()
+            doc_word.eliminate_zeros()
+            ii = np.repeat(np.arange(doc_word.shape[0]), np.diff(doc_word.indptr))
+            jj, ss = doc_word.indices, doc_word.data
         else:
+            ii, jj = np.nonzero(doc_word)
             ss = doc_word[ii, jj]
 
-        n_tokens = int(doc_word.sum())
         DS = np.repeat(ii, ss).astype(np.intc)
-        WS = np.empty(n_tokens, dtype=np.intc)
-        startidx = 0
-        for i, cnt in enumerate(ss):
-            cnt = int(cnt)
-            WS[startidx:startidx + cnt] = jj[i]
-            startidx += cnt
+        WS = np.repeat(jj, ss).astype(np.intc)
         return WS, DS
 
     def lists_to_matrix(self, WS, DS):
@@ -0,0 +1,72 @@
+"""Checks of the topic labeling of the mains on slices whose vocabulary grows
+
+Run with `python -m pytest test_labeling.py` from src/.
+"""
+from __future__ import division
+
+import numpy as np
+import pytest
+
+import main
+import main_add_views
+import main_doc_level
+from labeling import slice_stats
+from vocabulary import Vocabulary
+
+# two slices of docs of sentences, the second bringing the words "widget" and "sync"
+RAWINPUT = [
+    [[["app", "crash", "when", "open", "login", "screen"], ["login", "fail"]],
+     [["crash", "after", "update", "login", "screen", "again"]],
+     [["great", "update", "but", "login", "crash"]]],
+    [[["widget", "sync", "crash", "after", "update", "today"]],
+     [["sync", "fail", "login", "screen", "widget", "broken"], ["widget", "crash"]],
+     [["new", "widget", "great", "but", "sync", "slow"]]],
+]
+RATES = [np.array([1.0, 2.0, 4.0]), np.array([1.0, 1.0, 3.0])]
+LABELS = ["crash", "login", "screen", "update", "widget", "sync"]
+
+
+def grown_slices(n_topics=3, seed=0):
+    """The stats of RAWINPUT and phis of its slices padded to the final vocabulary as OLDA_fit pads them"""
+    rng = np.random.RandomState(seed)
+    dictionary = Vocabulary()
+    phis = []
+    for slice_i in RAWINPUT:
+        dictionary.add_documents(sentence for doc in slice_i for sentence in doc)
+        phis.append(rng.dirichlet(np.ones(len(dictionary)), n_topics))
+    assert phis[0].shape[1] < len(dictionary)
+    phis = [np.pad(phi, ((0, 0), (0, len(dictionary) - phi.shape[1])), 'constant') for phi in phis]
+    return dictionary, slice_stats(dictionary, RAWINPUT, RATES), phis
+
+
+def test_label_and_detect_scores_stay_finite_when_the_vocabulary_grows():
+    dictionary, stats, phis = grown_slices()
+    label_ids = main.get_candidate_label_ids(dictionary, LABELS, stats)
+    count = main.count_occurence(stats, label_ids)
+    total_count = main.total_count_(stats)
+    sensi_label = main.get_sensitivities(stats, label_ids)
+    sent_ids, sent_rates = main.get_candidate_sentences_ids(stats)
+    sensi_sent = main.get_sensitivities_sent(stats, sent_rates, sent_ids)
+    for module in (main, main_add_views, main_doc_level):
+        for t_i, phi in enumerate(phis):
+            sent_scores = module.topic_label_sent(stats[t_i], phi, sent_ids[t_i], sensi_sent[t_i], 0.2, 0.5)
+            assert np.isfinite(sent_scores).all()
+        # a history of identical slices, so that every topic of the newer slice is emerging
+        jsds = [0.0] * 3 * len(phis[1])
+        label_scores, sent_scores = module.topic_detect(
+            stats[1], phis[1], phis[0], count[1], count[0], total_count[1], total_count[0], label_ids[1],
+            sent_ids[1], sensi_label[1], sensi_sent[1], jsds, 0.5, 0.2, 0.5)
+        assert np.any(label_scores) and np.any(sent_scores)
+        assert np.isfinite(label_scores).all() and np.isfinite(sent_scores).all()
+
+
+def test_count_width_rejects_phrases_that_are_no_labels():
+    dictionary, stats, phis = grown_slices()
+    label_ids = main.get_candidate_label_ids(dictionary, LABELS, stats)
+    count = main.count_occurence(stats, label_ids)
+    sensi_label = main.get_sensitivities(stats, label_ids)
+    for module in (main, main_add_views, main_doc_level):
+        width = module.count_width(dictionary, [["crash", "login"]], count[0], sensi_label[0], label_ids[0])
+        assert np.isfinite(width).all()
+        with pytest.raises(ValueError):
+            module.count_width(dictionary, [["crash", "app"]], count[0], sensi_label[0], label_ids[0])
@@ -0,0 +1,148 @@
+"""Checks of the sampling kernels of _lda against the exact posterior of a small corpus, and of their
+parallel sweeps
+
+Run with `python -m pytest test_lda.py` from src/ once _lda is built.
+"""
+from __future__ import division
+import itertools
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.special import gammaln
+
+import _lda
+from onlineLDA import OLDA, _CompactPrior
+
+# two docs of three tokens over three words
+WS = np.array([0, 1, 0, 2, 1, 2], dtype=np.intc)
+DS = np.array([0, 0, 0, 1, 1, 1], dtype=np.intc)
+N_TOPICS = 3
+ALPHA = np.full((2, N_TOPICS), 0.3)
+ETA = np.array([[0.05, 0.2, 0.1],
+                [0.3, 0.05, 0.05],
+                [0.1, 0.1, 0.4]])
+
+
+def exact_posterior(WS, DS, alpha, eta):
+    """p(z | w) of every assignment z of the tokens, z enumerated as by itertools.product"""
+    n_topics, W = eta.shape
+    log_p = []
+    for z in itertools.product(range(n_topics), repeat=len(WS)):
+        nzw = np.zeros((n_topics, W))
+        ndz = np.zeros(alpha.shape)
+        np.add.at(nzw, (list(z), WS), 1)
+        np.add.at(ndz, (DS, list(z)), 1)
+        log_p.append(gammaln(nzw + eta).sum() - gammaln(nzw.sum(1) + eta.sum(1)).sum() +
+                     gammaln(ndz + alpha).sum() - gammaln(ndz.sum(1) + alpha.sum(1)).sum())
+    p = np.exp(np.array(log_p) - max(log_p))
+    return p / p.sum()
+
+
+def sampled_posterior(sampler, WS, DS, alpha, eta, n_sweeps, mh_steps=4, seed=1):
+    """Frequencies of the assignments visited by `n_sweeps` sweeps of a kernel
+
+    eta is a dense array or a _CompactPrior, which the sparse and alias
+    kernels take as its floor and residual as OLDA does.
+    """
+    n_topics, W = eta.shape
+    ZS = (np.arange(len(WS)) % n_topics).astype(np.intc)
+    nzw = np.zeros((n_topics, W), dtype=np.intc)
+    ndz = np.zeros(alpha.shape, dtype=np.intc)
+    np.add.at(nzw, (ZS, WS), 1)
+    np.add.at(ndz, (DS, ZS), 1)
+    nz = nzw.sum(axis=1).astype(np.intc)
+    eta_sum = eta.sum(axis=1)
+    alpha_floor = alpha.min(axis=1)
+    alpha_flat = (alpha.max(axis=1) == alpha_floor).astype(np.intc)
+    if isinstance(eta, _CompactPrior):
+        eta_floor = np.full(W, eta.floor)
+        eta_res = eta.residual.tocsc()
+        eta = eta.toarray()
+    else:
+        eta_floor = eta.min(axis=0)
+        eta_res = sparse.csc_matrix(eta - eta_floor)
+    res_args = (eta_floor, eta_res.indptr.astype(np.intc), eta_res.indices.astype(np.intc),
+                eta_res.data.astype(np.float64))
+    rng_state = np.array([seed], dtype=np.uint64)
+    place = n_topics ** np.arange(len(WS))[::-1]
+    visits = np.zeros(n_topics ** len(WS))
+    for sweep in range(n_sweeps):
+        if sampler == 'sparse':
+            _lda._sample_topics_sparse(WS, DS, ZS, nzw, ndz, nz, alpha, alpha_floor, alpha_flat,
+                                       *(res_args + (eta_sum, rng_state)))
+        elif sampler == 'alias':
+            _lda._sample_topics_alias(WS, DS, ZS, nzw, ndz, nz, alpha, alpha.sum(axis=1), alpha_flat,
+                                      *(res_args + (eta_sum, rng_state, mh_steps)))
+        else:
+            _lda._sample_topics(WS, DS, ZS, nzw, ndz, nz, alpha, eta, eta_sum, rng_state)
+        visits[np.dot(ZS, place)] += 1
+    return visits / n_sweeps
+
+
+def total_variation(p, q):
+    return 0.5 * np.abs(p - q).sum()
+
+
+def test_dense_sampler_matches_exact_posterior():
+    p = exact_posterior(WS, DS, ALPHA, ETA)
+    assert total_variation(sampled_posterior('dense', WS, DS, ALPHA, ETA, 200000), p) < 0.02
+
+
+def test_sparse_sampler_matches_exact_posterior():
+    p = exact_posterior(WS, DS, ALPHA, ETA)
+    assert total_variation(sampled_posterior('sparse', WS, DS, ALPHA, ETA, 200000), p) < 0.02
+
+
+def test_alias_sampler_approaches_exact_posterior():
+    # the stale word tables leave a bias that shrinks with the number of Metropolis-Hastings steps
+    p = exact_posterior(WS, DS, ALPHA, ETA)
+    assert total_variation(sampled_posterior('alias', WS, DS, ALPHA, ETA, 200000, mh_steps=10), p) < 0.025
+    assert total_variation(sampled_posterior('alias', WS, DS, ALPHA, ETA, 200000, mh_steps=4), p) < 0.04
+
+
+def test_truncated_prior_has_non_negative_residual():
+    # topics of different scales, so that the kept values of some are below the mean of all cut ones
+    eta = np.random.RandomState(0).gamma(0.5, 0.02, size=(20, 500)) * np.logspace(-1, 1, 20)[:, np.newaxis]
+    for top_k in (1, 100, 250, 400):
+        prior = _CompactPrior.truncate(eta, top_k)
+        assert (prior.residual.data >= 0).all()
+        assert prior.residual.nnz <= 20 * top_k
+
+
+def test_sparse_sampler_matches_dense_on_truncated_prior():
+    # the kept 0.05 of the second topic is below the mean of the values that are cut
+    prior = _CompactPrior.truncate(ETA, 2)
+    p = exact_posterior(WS, DS, ALPHA, prior.toarray())
+    assert total_variation(sampled_posterior('dense', WS, DS, ALPHA, prior.toarray(), 200000), p) < 0.02
+    assert total_variation(sampled_posterior('sparse', WS, DS, ALPHA, prior, 200000), p) < 0.02
+
+
+def fit_time(X, sampler, n_jobs, n_iter=50):
+    """Seconds OLDA takes to fit X, the best of three runs"""
+    times = []
+    for run in range(3):
+        model = OLDA(20, n_iter=n_iter, refresh=n_iter, random_state=1, sampler=sampler, n_jobs=n_jobs)
+        start = time.time()
+        model.fit([X], 0, 0)
+        times.append(time.time() - start)
+    return min(times)
+
+
+@pytest.mark.skipif(multiprocessing.cpu_count() < 2, reason="threads can only overlap on more than one CPU")
+@pytest.mark.parametrize('sampler', ['dense', 'sparse', 'alias'])
+def test_parallel_sweeps_overlap(sampler):
+    # the kernels run without the GIL, a helper taking it for an exception check would serialise the threads
+    rng = np.random.RandomState(0)
+    D, W = 4000, 2000
+    lengths = rng.randint(20, 80, D)
+    rows = np.repeat(np.arange(D), lengths)
+    X = sparse.csr_matrix((np.ones(len(rows), dtype=np.intc), (rows, rng.zipf(1.2, len(rows)) % W)), shape=(D, W))
+    logging.disable(logging.WARNING)
+    try:
+        assert fit_time(X, sampler, 2) < 0.8 * fit_time(X, sampler, 1)
+    finally:
+        logging.disable(logging.NOTSET)
@@ -0,0 +1,145 @@
+"""
+On-disk cache of the output of extractSentenceWords
+
+The tokenised sentences of a list of documents are stored as one
+memory-mapped array of token ids with sentence and document offsets, under
+a directory named by a hash of the documents and the tokeniser options, so
+that later runs and later stages read them back instead of tokenising again.
+Documents that are not cached are tokenised by a pool of worker processes.
+"""
+import os
+import shutil
+import hashlib
+import logging
+import numpy as np
+from multiprocessing import Pool
+from extractSentenceWords import get_tokenizer
+
+# bump when the output of extractSentenceWords or the store layout changes
+CACHE_VERSION = 1
+# documents handed to a worker process at a time
+CHUNK_SIZE = 500
+
+
+class TokenStore(object):
+    """Tokenised documents, indexed like the list of documents they come from
+
+    store[i] is the (wordsInSentences, wc) that extractSentenceWords returned
+    for document i.
+    """
+
+    def __init__(self, vocab, tokens, sent_offsets, doc_offsets):
+        self.vocab = vocab                  # token id -> word
+        self.tokens = tokens                # token ids of all sentences, one after another
+        self.sent_offsets = sent_offsets    # sentence j is tokens[sent_offsets[j]:sent_offsets[j + 1]]
+        self.doc_offsets = doc_offsets      # document i is sentences doc_offsets[i] to doc_offsets[i + 1] - 1
+
+    def __len__(self):
+        return len(self.doc_offsets) - 1
+
+    def __getitem__(self, i):
+        vocab = self.vocab
+        offsets = self.sent_offsets[self.doc_offsets[i]:self.doc_offsets[i + 1] + 1].tolist()
+        base = offsets[0]
+        words = [vocab[t] for t in self.tokens[base:offsets[-1]].tolist()]
+        wordsInSentences = [words[start - base:end - base] for start, end in zip(offsets[:-1], offsets[1:])]
+        return wordsInSentences, len(words)
+
+    @classmethod
+    def build(cls, docs, n_workers=1, **options):
+        token2id = {}
+        vocab = []
+        tokens = []
+        sent_offsets = [0]
+        doc_offsets = [0]
+        for wordsInSentences, wc in parallel_imap(get_tokenizer(**options), docs, n_workers):
+            for words in wordsInSentences:
+                for w in words:
+                    t = token2id.get(w)
+                    if t is None:
+                        t = token2id[w] = len(vocab)
+                        vocab.append(w)
+                    tokens.append(t)
+                sent_offsets.append(len(tokens))
+            doc_offsets.append(len(sent_offsets) - 1)
+        return cls(vocab, np.array(tokens, dtype=np.int32), np.array(sent_offsets, dtype=np.int64),
+                   np.array(doc_offsets, dtype=np.int64))
+
+    def save(self, path):
+        os.makedirs(path)
+        # words never contain whitespace, one per line keeps them as the byte strings they were
+        with open(os.path.join(path, "vocab.txt"), 'wb') as fout:
+            fout.write("\n".join(self.vocab))
+        np.save(os.path.join(path, "tokens.npy"), self.tokens)
+        np.save(os.path.join(path, "sent_offsets.npy"), self.sent_offsets)
+        np.save(os.path.join(path, "doc_offsets.npy"), self.doc_offsets)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "vocab.txt"), 'rb') as fin:
+            vocab = fin.read().split("\n")
+        return cls(vocab, np.load(os.path.join(path, "tokens.npy"), mmap_mode='r'),
+                   np.load(os.path.join(path, "sent_offsets.npy"), mmap_mode='r'),
+                   np.load(os.path.join(path, "doc_offsets.npy")))
+
+
+def parallel_imap(func, items, n_workers=1, chunksize=CHUNK_SIZE):
+    """
+    func over items in n_workers processes, yielding the results in the order of items as they come in
+    :param func: picklable callable, e.g. a module level function or a SentenceTokenizer; the workers are forked,
+    so it sees the module globals as they were at the first next()
+    :param items: iterable of arguments of func
+    :param n_workers: number of worker processes, 1 for calling func in this process
+    :param chunksize: number of items sent to a worker at a time
+    """
+    if n_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = Pool(n_workers)
+    try:
+        for result in pool.imap(func, items, chunksize):
+            yield result
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        # also when the caller stops early: terminating a pool with tasks in flight can hang
+        pool.close()
+        pool.join()
+
+
+def cache_key(docs, **options):
+    h = hashlib.sha1()
+    h.update("%d %r" % (CACHE_VERSION, sorted(options.items())))
+    for doc in docs:
+        h.update(doc.encode('utf-8') if isinstance(doc, unicode) else doc)
+        h.update("\0")
+    return h.hexdigest()
+
+
+def tokenize_docs(docs, cache_dir=None, n_workers=1, **options):
+    """
+    extractSentenceWords over all docs, read from cache_dir if the same docs were tokenised with the same options
+    :param docs: list of documents
+    :param cache_dir: directory of the cache, None for no caching
+    :param n_workers: number of processes tokenising the docs when they are not cached
+    :param options: keyword arguments of extractSentenceWords, except sent
+    :return: TokenStore of the docs
+    """
+    if cache_dir is None:
+        return TokenStore.build(docs, n_workers, **options)
+    path = os.path.join(cache_dir, cache_key(docs, **options))
+    if os.path.isdir(path):
+        logging.info("read %d tokenised docs from %s" % (len(docs), path))
+        return TokenStore.load(path)
+    store = TokenStore.build(docs, n_workers, **options)
+    # write aside and rename, so that an interrupted run leaves no partial entry
+    tmp_path = path + ".tmp%d" % os.getpid()
+    store.save(tmp_path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:     # written by another run in the meantime
+        shutil.rmtree(tmp_path)
+    logging.info("cached %d tokenised docs in %s" % (len(docs), path))
+    return store
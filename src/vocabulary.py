@@ -0,0 +1,88 @@
+import json
+from collections import defaultdict
+
+
+class Vocabulary(object):
+    """Word <-> id index over time slices that only ever appends ids
+
+    A drop-in for the parts of gensim's `Dictionary` used here (`token2id`,
+    `doc2bow`, `values`, indexing by id), except that adding the documents of
+    a new slice never renumbers the words already in it, so the matrices of
+    earlier slices stay valid and only need padding to the new width.
+
+    Words are admitted once their document frequency over all slices seen so
+    far reaches `no_below` while being at most `no_above` of the documents
+    (the filters of `Dictionary.filter_extremes`), and never once the index
+    holds `keep_n` words.
+    """
+
+    def __init__(self, no_below=1, no_above=1.0, keep_n=None, bad_tokens=()):
+        self.no_below = no_below
+        self.no_above = no_above
+        self.keep_n = keep_n
+        self.bad_tokens = set(bad_tokens)
+        self.token2id = {}
+        self.id2token = []
+        # document frequencies of every word seen, admitted or not
+        self.dfs = defaultdict(int)
+        self.num_docs = 0
+
+    def __len__(self):
+        return len(self.id2token)
+
+    def __getitem__(self, token_id):
+        return self.id2token[token_id]
+
+    def keys(self):
+        return list(range(len(self.id2token)))
+
+    def values(self):
+        return list(self.id2token)
+
+    def add_documents(self, documents):
+        """Count the documents and append the words that now pass the filters
+
+        :param documents: iterable of lists of words
+        :return: number of new ids
+        """
+        for document in documents:
+            self.num_docs += 1
+            for word in set(document):
+                self.dfs[word] += 1
+        max_df = self.no_above * self.num_docs
+        new_words = [word for word, df in self.dfs.items()
+                     if self.no_below <= df <= max_df and word not in self.token2id and word not in self.bad_tokens]
+        # most frequent first, so that keep_n keeps the same words as filter_extremes would
+        new_words.sort(key=lambda word: (-self.dfs[word], word))
+        if self.keep_n is not None:
+            new_words = new_words[:max(self.keep_n - len(self), 0)]
+        for word in new_words:
+            self.token2id[word] = len(self.id2token)
+            self.id2token.append(word)
+        return len(new_words)
+
+    def doc2bow(self, document):
+        """List of (id, count) of the known words of a document, sorted by id"""
+        counts = defaultdict(int)
+        for word in document:
+            token_id = self.token2id.get(word)
+            if token_id is not None:
+                counts[token_id] += 1
+        return sorted(counts.items())
+
+    def save(self, path):
+        with open(path, 'w') as fout:
+            json.dump({'no_below': self.no_below, 'no_above': self.no_above, 'keep_n': self.keep_n,
+                       'bad_tokens': sorted(self.bad_tokens), 'id2token': self.id2token,
+                       'dfs': self.dfs, 'num_docs': self.num_docs}, fout)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fin:
+            state = json.load(fin)
+        vocabulary = cls(state['no_below'], state['no_above'], state['keep_n'], state['bad_tokens'])
+        vocabulary.id2token = state['id2token']
+        vocabulary.token2id = dict((word, i) for i, word in enumerate(vocabulary.id2token))
+        vocabulary.dfs.update(state['dfs'])
+        vocabulary.num_docs = state['num_docs']
+        return vocabulary